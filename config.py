@@ -1,3 +1,5 @@
+import datetime
+
 # emojis: https://apps.timwhitlock.info/emoji/tables/unicode
 emojis = {
     'back': u'\U00002b05',
@@ -12,4 +14,149 @@ emojis = {
     'airplane': u'\U00002708',
     'snowman': u'\U000026C4',
     'raised_hand': u'\U0000270B'
-}
\ No newline at end of file
+}
+
+# Google spreadsheet snapshot: the sheet is kept in memory and refreshed in the background every `ttl` seconds.
+# The last snapshot and access token are saved to disk, so a restart serves from them right away
+spreadsheet = {
+    'ttl': 300,
+    'index_keys': ['Name', 'Phone number'],
+    'snapshot_path': 'spreadsheet.json',
+    'token_path': 'spreadsheet_token.json',
+}
+
+# Today's official exchange rates are downloaded once a day at this time (server time)
+exchange_rates = {
+    'prefetch_time': datetime.time(hour=0, minute=5),
+}
+
+# Activity log rows are written in batches of `batch_size` rows or every `flush_interval_ms`.
+# `overflow` decides what happens when the queue is full: 'block', 'drop_oldest' or 'sample' (keep `sample_rate` of rows)
+activity_log = {
+    'queue_size': 10000,
+    'batch_size': 100,
+    'flush_interval_ms': 500,
+    'overflow': 'drop_oldest',
+    'sample_rate': 0.1,
+}
+
+# Activity log rows older than retention_days are moved to gzipped files in archive_dir every day at run_time
+activity_log_retention = {
+    'retention_days': 90,
+    'archive_dir': 'archive',
+    'chunk_size': 500,
+    'chunk_pause_ms': 50,
+    'run_time': datetime.time(3, 0),
+}
+
+# activity_log rows are rolled up into usage_hourly/usage_daily every `interval` seconds, for /stats
+usage_rollup = {
+    'interval': 60,
+    'batch_size': 5000,
+}
+
+# Authenticated users are cached in memory until their authorization expires
+sessions = {
+    'max_size': 10000,
+}
+
+# Expired authorizations are cleared in one batch every `expire_interval` seconds
+users = {
+    'expire_interval': 600,
+}
+
+# Authorized users get a message when their salary or day-offs change in the spreadsheet, see src/notifications.py
+change_notifications = {
+    'enabled': True,
+}
+
+# Static screens are rebuilt when env.py has changed, checked every `reload_interval` seconds
+screens = {
+    'reload_interval': 60,
+}
+
+# Receive updates through a local webhook listener instead of long polling.
+# Telegram must reach `env.webhook_url`, which is expected to proxy to listen:port/path
+webhook = {
+    'enabled': False,
+    'listen': '0.0.0.0',
+    'port': 8443,
+    'path': '/telegram',
+    'drain_timeout': 30,
+}
+
+# Slow callbacks run in a pool of `size` threads. If the answer isn't ready after the handler's deadline (seconds),
+# the button is acknowledged with "Loading…" right away and the answer is sent as a message once ready
+workers = {
+    'size': 8,
+    'deadlines': {
+        'salary': 1.0,
+        'day_offs_mine': 1.0,
+        'currency': 2.0,
+    },
+}
+
+# Telegram flood limits: messages per second for the bot overall and for a single chat
+outbound = {
+    'global_rate': 30,
+    'per_chat_rate': 1,
+    'per_chat_burst': 3,
+    'broadcast_queue_size': 1000,
+    'max_retries': 3,
+}
+
+# shards > 1: one process receives updates and hands them to `shards` bot processes by chat_id, see src/sharding.py
+sharding = {
+    'shards': 1,
+    'queue_size': 10000,
+    'restart_delay': 1,
+    'report_interval': 60,
+    'sync_check_interval': 30,
+}
+
+# Circuit breakers and retries of upstream calls, see src/resilience.py.
+# An open circuit fails calls right away for reset_timeout seconds, the last known-good data is served meanwhile
+resilience = {
+    'spreadsheet': {
+        'failure_threshold': 3,
+        'reset_timeout': 120,
+        'attempts': 3,
+        'base_delay': 1,
+        'max_delay': 10,
+    },
+    'bnm': {
+        'failure_threshold': 3,
+        'reset_timeout': 60,
+        'attempts': 2,
+        'base_delay': 0.2,
+        'max_delay': 1,
+    },
+}
+
+# What every menu message shows is remembered for `ttl` seconds, edits that wouldn't change it are skipped
+render_state = {
+    'ttl': 3600,
+    'max_size': 50000,
+}
+
+# Prometheus metrics on http://listen:port/metrics
+metrics = {
+    'enabled': True,
+    'listen': '127.0.0.1',
+    'port': 9090,
+}
+
+# Admin /profile <seconds> and `kill -USR2 <pid>` sample all threads every `interval_ms`, see src/profiler.py.
+# In sharded mode the supervisor passes the signal on to every bot process, each writes its own profile-<pid>-*.txt
+profiling = {
+    'interval_ms': 10,
+    'max_seconds': 60,
+    'signal_seconds': 30,
+    'output_dir': 'profiles',
+}
+
+# Updates taking over `threshold_ms` in the handlers are kept with their phase timings, the last `size` of them (admin /slow)
+slow_updates = {
+    'threshold_ms': 500,
+    'size': 200,
+}
@@ -1,6 +1,9 @@
 # Purpose of this file is to show structure of "env.py". Do not use it in production
 
 telegram_bot_token = ''
+telegram_base_url = None  # Bot API url, None for https://api.telegram.org/bot (see src/fake_telegram.py)
+webhook_url = ''  # public https url of the webhook listener, used when config.webhook['enabled']
+webhook_secret_token = ''  # 1-256 characters A-Z, a-z, 0-9, _ and -
 google_spreadsheet_keyfile_dict = {
     "type": "",
     "project_id": "",
@@ -15,6 +18,10 @@ google_spreadsheet_keyfile_dict = {
 }
 google_spreadsheet_url = ''
 
+admin_user_ids = [
+    # Telegram user ids allowed to use admin commands (/broadcast, ...)
+]
+
 about = {
     'info': "",
     'website': ""
@@ -0,0 +1,233 @@
+import datetime
+import gzip
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+def encode_payload(data):
+    return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_payload(payload):
+    return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+
+def update_to_dict(update):
+    # to_dict() also returns cached private attributes such as _effective_message
+    return {key: value for key, value in update.to_dict().items() if not key.startswith('_')}
+
+
+def get_update_kind(update):
+    if update.callback_query is not None:
+        return 'callback'
+    message = update.effective_message
+    if message is None:
+        return 'other'
+    if message.contact is not None:
+        return 'contact'
+    if message.text and message.text.startswith('/'):
+        return 'command'
+    return 'text'
+
+
+class ActivityLogWriter:
+    """Write-behind activity log: rows are queued in memory and inserted in batches by one writer thread"""
+
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    SAMPLE = 'sample'
+
+    def __init__(self, db, queue_size=10000, batch_size=100, flush_interval_ms=500, overflow=DROP_OLDEST, sample_rate=0.1):
+        if overflow not in (self.BLOCK, self.DROP_OLDEST, self.SAMPLE):
+            raise ValueError(f'Unknown overflow policy: {overflow}')
+        self.__db = db
+        self.__queue = queue.Queue(maxsize=queue_size)
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval_ms / 1000
+        self.__overflow = overflow
+        self.__sample_rate = sample_rate
+        self.__stop = object()
+        self.__thread = None
+        self.__lock = threading.Lock()
+        self.__counters = {'queued': 0, 'written': 0, 'dropped': 0}
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, name='activity-log-writer', daemon=True)
+        self.__thread.start()
+
+    def close(self, timeout=10):
+        """Flushes everything queued so far and stops the writer thread"""
+        if self.__thread is None:
+            return
+        self.__queue.put(self.__stop)
+        self.__thread.join(timeout)
+        self.__thread = None
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__counters)
+        stats['queue_size'] = self.__queue.qsize()
+        return stats
+
+    def __count(self, counter, n=1):
+        with self.__lock:
+            self.__counters[counter] += n
+
+    def log(self, user_id, callback, message, update, when_created):
+        # The update is serialized by the writer thread, off the handler's path
+        row = (user_id, callback, message, update, when_created)
+        try:
+            self.__queue.put_nowait(row)
+        except queue.Full:
+            if self.__overflow == self.BLOCK:
+                self.__queue.put(row)
+            elif self.__overflow == self.DROP_OLDEST:
+                if not self.__replace_oldest(row):
+                    return
+            elif random.random() < self.__sample_rate:  # SAMPLE: keep a share of rows, in place of the oldest ones
+                if not self.__replace_oldest(row):
+                    return
+            else:
+                self.__count('dropped')
+                return
+        self.__count('queued')
+
+    def __replace_oldest(self, row):
+        # Never waits: the handler thread must not stall when the writer falls behind
+        try:
+            self.__queue.get_nowait()
+            self.__count('dropped')
+        except queue.Empty:
+            pass
+        try:
+            self.__queue.put_nowait(row)
+        except queue.Full:
+            self.__count('dropped')
+            return False
+        return True
+
+    def __run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.__queue.get()]
+            deadline = time.monotonic() + self.__flush_interval
+            while len(batch) < self.__batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.__queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            if self.__stop in batch:
+                stopping = True
+                batch.remove(self.__stop)
+                # drain whatever is still queued, the writer won't come back for it
+                while True:
+                    try:
+                        batch.append(self.__queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+            if batch:
+                self.__write(batch)
+
+    def __write(self, batch):
+        try:
+            rows = [
+                (update.update_id, user_id, get_update_kind(update), callback, message,
+                 encode_payload(update_to_dict(update)), when_created)
+                for user_id, callback, message, update, when_created in batch
+            ]
+            with self.__db.transaction() as cur:
+                cur.executemany(
+                    """
+                        INSERT INTO activity_log(update_id, user_id, kind, callback, message, payload, when_created)
+                        VALUES(?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    rows
+                )
+            self.__count('written', len(batch))
+        except Exception:
+            logger.exception(f'Could not write {len(batch)} activity log rows')
+            self.__count('dropped', len(batch))
+
+
+class ActivityLogArchiver:
+    """
+    Moves activity log rows older than `retention_days` to gzipped JSON lines, one file per day:
+    archive_dir/activity_log-YYYY-MM-DD.jsonl.gz. Rows are archived, deleted and vacuumed in chunks,
+    every chunk is its own short transaction so the live writer is never blocked for long.
+    A row is written to the archive before it's deleted: after a crash it may be archived twice, never lost.
+    """
+
+    def __init__(self, db, archive_dir='archive', retention_days=90, chunk_size=500, chunk_pause_ms=50):
+        self.__db = db
+        self.__archive_dir = archive_dir
+        self.__retention_days = retention_days
+        self.__chunk_size = chunk_size
+        self.__chunk_pause = chunk_pause_ms / 1000
+        self.__running = threading.Lock()
+
+    def run(self, now=None):
+        """Returns the number of archived rows, or None if another run is in progress"""
+        if not self.__running.acquire(blocking=False):
+            return None
+        try:
+            # when_created is written by Bot.logger as UTC + 2, the cutoff must be on the same clock
+            return self.__run(now or datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=2))
+        finally:
+            self.__running.release()
+
+    def __run(self, now):
+        cutoff = (now - datetime.timedelta(days=self.__retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+        os.makedirs(self.__archive_dir, exist_ok=True)
+        started = time.monotonic()
+        archived = 0
+        while True:
+            rows = self.__db.execute(
+                """
+                    SELECT id, update_id, user_id, kind, callback, message, update_query, payload, when_created
+                    FROM activity_log
+                    WHERE when_created < ?
+                    ORDER BY when_created, id
+                    LIMIT ?
+                """,
+                cutoff,
+                self.__chunk_size
+            ).fetchall()
+            if not rows:
+                break
+
+            self.__archive(rows)
+            with self.__db.transaction() as cur:
+                cur.executemany('DELETE FROM activity_log WHERE id = ?', [(row['id'],) for row in rows])
+            self.__db.incremental_vacuum()
+            archived += len(rows)
+            time.sleep(self.__chunk_pause)  # let the live writer in
+
+        logger.info(f'Archived {archived} activity log rows older than {cutoff} in {time.monotonic() - started:.1f}s')
+        return archived
+
+    def __archive(self, rows):
+        days = {}
+        for row in rows:
+            record = {key: row[key] for key in row.keys() if key != 'payload'}
+            if row['payload'] is not None:
+                record['update'] = decode_payload(row['payload'])
+            days.setdefault(row['when_created'][:10], []).append(json.dumps(record, ensure_ascii=False))
+
+        for day, lines in days.items():
+            path = os.path.join(self.__archive_dir, f'activity_log-{day}.jsonl.gz')
+            # Appending adds a gzip member, readers see one continuous file
+            with gzip.open(path, 'at', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
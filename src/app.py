@@ -2,8 +2,18 @@ import sys
 
 sys.path.append("../")
 
-from src.bot import Bot
+import config as config_global
+from src.startup import StartupReport, configure_logging
 
 if __name__ == '__main__':
-    bot = Bot()
-    bot.idle()
+    configure_logging()
+    if config_global.sharding['shards'] > 1:
+        from src.sharding import ShardSupervisor
+
+        ShardSupervisor(config_global.sharding['shards']).run()
+    else:
+        startup = StartupReport()
+        with startup.phase('imports'):
+            from src.bot import Bot
+        bot = Bot(startup=startup)
+        bot.idle()
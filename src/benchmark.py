@@ -0,0 +1,296 @@
+import argparse
+import ast
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+
+sys.path.append("../")
+
+import env
+import src.utils
+from src.activity_log import decode_payload
+from src.fake_telegram import FakeServer, FakeTelegramApi, make_callback_update, make_contact_update, make_text_update, percentile
+from src.google_spreadsheet import EmployeeRecord, SpreadsheetSnapshot
+from src.menu import encode_callback, parse_callback
+
+'''
+Offline benchmark of the Bot dispatch pipeline: Telegram, Google and bnm.md are replaced by fakes.
+
+Synthetic traffic:
+    python src/benchmark.py --updates 2000 --concurrency 16 --sheet-rows 5000 --sheet-latency 0.5
+Replay recorded traffic from activity_log:
+    python src/benchmark.py --replay database.db --concurrency 16
+'''
+
+# Share of every kind of update in synthetic traffic
+UPDATE_MIX = {
+    'start': 5,
+    'text': 5,
+    'contact': 2,
+    'main': 20,
+    'day_offs_menu': 10,
+    'day_offs_mine': 10,
+    'day_offs_paid': 5,
+    'salary': 20,
+    'currency': 15,
+    'help': 8,
+}
+
+EXCHANGE_RATES_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?><ValCurs Date="{date}" name="Official exchange rate">'
+    + ''.join(
+        f'<Valute ID="{currency_id}"><NumCode>{currency_id}</NumCode><CharCode>C{currency_id}</CharCode>'
+        f'<Nominal>1</Nominal><Name>Currency {currency_id}</Name><Value>{19 + currency_id / 100:.4f}</Value></Valute>'
+        for currency_id in range(1, 50)
+    )
+    + '</ValCurs>'
+)
+
+
+class FakeSpreadsheetReader:
+    """Stands in for GoogleSpreadsheetReader, every download of the sheet takes `latency` seconds"""
+
+    def __init__(self, records, latency=0.0):
+        self.records = records
+        self.latency = latency
+        self.downloads = 0
+        self.__listeners = []
+        self.__snapshot = None
+
+    def add_refresh_listener(self, listener):
+        self.__listeners.append(listener)
+
+    def refresh(self):
+        time.sleep(self.latency)
+        self.downloads += 1
+        self.__snapshot = SpreadsheetSnapshot(self.records, ['Name', 'Phone number'])
+        for listener in self.__listeners:
+            listener(self.__snapshot)
+        return self.__snapshot
+
+    def start_refresher(self):
+        pass
+
+    @property
+    def snapshot(self):
+        return self.__snapshot or self.refresh()
+
+    def get_all_records(self):
+        return self.snapshot.records
+
+    def get_record_by_condition(self, key, value):
+        return self.snapshot.find(key, value)
+
+
+class FakeExchangeRatesHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        self.server.requests += 1
+        body = EXCHANGE_RATES_XML.format(date=time.strftime('%d.%m.%Y')).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_exchange_rates(latency):
+    httpd = FakeServer(('127.0.0.1', 0), FakeExchangeRatesHandler)
+    httpd.latency = latency
+    httpd.requests = 0
+    threading.Thread(target=httpd.serve_forever, name='fake-bnm', daemon=True).start()
+    return httpd
+
+
+def make_sheet(rows):
+    return [
+        EmployeeRecord(name=f'User{i} Bench', phone_number=f'+1000{i:06d}', salary=1000 + i, day_offs=i % 28)
+        for i in range(1, rows + 1)
+    ]
+
+
+def seed_users(db_path, chats):
+    # Chats 1..chats are registered and authorized, matching rows of make_sheet()
+    con = sqlite3.connect(db_path)
+    con.executemany(
+        """
+            INSERT OR REPLACE INTO users(user_id, first_name, last_name, phone_number, when_authorized)
+            VALUES(?, ?, 'Bench', ?, datetime('now'))
+        """,
+        [(i, f'User{i}', f'1000{i:06d}') for i in range(1, chats + 1)]
+    )
+    con.commit()
+    con.close()
+
+
+def make_synthetic_updates(count, chats):
+    kinds = list(UPDATE_MIX)
+    weights = [UPDATE_MIX[kind] for kind in kinds]
+    updates = []
+    for kind in random.choices(kinds, weights, k=count):
+        chat_id = random.randint(1, chats)
+        if kind == 'start':
+            updates.append(make_text_update(chat_id, '/start'))
+        elif kind == 'text':
+            updates.append(make_text_update(chat_id, 'hello'))
+        elif kind == 'contact':
+            updates.append(make_contact_update(chat_id, f'1000{chat_id:06d}'))
+        else:
+            updates.append(make_callback_update(chat_id, encode_callback(kind)))
+    return updates
+
+
+def load_recorded_updates(db_path, limit):
+    con = sqlite3.connect(db_path)
+    try:
+        rows = con.execute('SELECT payload, update_query FROM activity_log ORDER BY id LIMIT ?', (limit,)).fetchall()
+    finally:
+        con.close()
+    # Older rows have no payload, their update_query holds str(update): the repr of Update.to_dict()
+    return [decode_payload(payload) if payload else ast.literal_eval(update_query) for payload, update_query in rows
+            if payload or update_query]
+
+
+def get_update_label(update):
+    """Menu node or command an update is timed under, finer than activity_log.get_update_kind()"""
+    if update.callback_query is not None:
+        return parse_callback(update.callback_query.data)[1] or 'callback'
+    message = update.effective_message
+    if message is not None and message.contact is not None:
+        return 'contact'
+    if message is not None and message.text and message.text.startswith('/'):
+        return message.text.split()[0]
+    return 'text'
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.__lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.__lock:
+            self.latencies[name].append(seconds)
+
+    def instrument(self, dispatcher):
+        # Every handler callback in every group is timed under "group:callback name"
+        for group, handlers in dispatcher.handlers.items():
+            for handler in handlers:
+                handler.callback = self.wrap(f'{group}:{handler.callback.__name__}', handler.callback)
+
+    def wrap(self, name, callback):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - started)
+
+        timed.__name__ = callback.__name__
+        return timed
+
+    def report(self):
+        lines = [f"{'name':<45} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"]
+        for name in sorted(self.latencies):
+            values = self.latencies[name]
+            lines.append(
+                f'{name:<45} {len(values):>7} '
+                + ' '.join(f'{percentile(values, p) * 1000:>9.2f}' for p in (50, 95, 99))
+            )
+        return '\n'.join(lines)
+
+
+def run(args):
+    from telegram import Update
+    from src.bot import Bot
+
+    api = FakeTelegramApi(latency=args.api_latency)
+    api.start()
+    env.telegram_base_url = api.base_url
+    bnm = start_fake_exchange_rates(args.bnm_latency)
+    src.utils.EXCHANGE_RATES_URL = f'http://127.0.0.1:{bnm.server_address[1]}/?date={{date}}'
+
+    workdir = tempfile.mkdtemp(prefix='bot-benchmark-')
+    db_path = os.path.join(workdir, 'database.db')
+    gsheet = FakeSpreadsheetReader(make_sheet(args.sheet_rows), latency=args.sheet_latency)
+    bot = Bot(db_path=db_path, token='123456:benchmark', gsheet=gsheet)
+    seed_users(db_path, min(args.chats, args.sheet_rows))
+    gsheet.refresh()
+
+    recorder = Recorder()
+    recorder.instrument(bot.dispatcher)
+
+    # Time from receiving a callback query until it's answered, including background work
+    telegram_bot = bot.dispatcher.bot
+    answer_callback_query = telegram_bot.answer_callback_query
+    pending_answers = {}
+
+    def timed_answer_callback_query(*a, **kwargs):
+        started = pending_answers.pop(kwargs.get('callback_query_id'), None)
+        if started is not None:
+            recorder.add(f'answer:{started[0]}', time.perf_counter() - started[1])
+        return answer_callback_query(*a, **kwargs)
+
+    telegram_bot.answer_callback_query = timed_answer_callback_query
+
+    if args.replay:
+        updates = load_recorded_updates(args.replay, args.updates)
+    else:
+        updates = make_synthetic_updates(args.updates, args.chats)
+    updates = [Update.de_json(json.loads(json.dumps(update)), telegram_bot) for update in updates]
+
+    def process(update):
+        label = get_update_label(update)
+        started = time.perf_counter()
+        if update.callback_query is not None:
+            pending_answers[update.callback_query.id] = (label, started)
+        bot.dispatcher.process_update(update)
+        recorder.add(f'dispatch:{label}', time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(process, updates))
+    dispatched = time.perf_counter() - started
+    bot.close()
+    finished = time.perf_counter() - started
+
+    print(recorder.report())
+    print()
+    print(f'{len(updates)} updates, concurrency {args.concurrency}')
+    print(f'dispatch throughput: {len(updates) / dispatched:.0f} updates/s')
+    print(f'end-to-end throughput: {len(updates) / finished:.0f} updates/s')
+    print(f'Telegram API calls: {dict(api.calls)}')
+    print(f'sheet downloads: {gsheet.downloads}, bnm.md requests: {bnm.requests}')
+    print(f'bnm.md single-flight: {src.utils.exchange_rates_flight.stats()}')
+    api.stop()
+    bnm.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmark of the bot handlers')
+    parser.add_argument('--updates', type=int, default=2000, help='number of updates (max number of replayed ones)')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--sheet-rows', type=int, default=1000)
+    parser.add_argument('--sheet-latency', type=float, default=0.5, help='seconds per sheet download')
+    parser.add_argument('--bnm-latency', type=float, default=0.3, help='seconds per bnm.md request')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='seconds per Telegram API call')
+    parser.add_argument('--replay', metavar='DATABASE', help='replay updates recorded in activity_log of this database')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    run(args)
@@ -1,20 +1,49 @@
 import datetime
+import functools
+import io
+import logging
+import os
+import signal
 import sys
+import threading
+import time
 
 sys.path.append("../")
 
 from src.google_spreadsheet import GoogleSpreadsheetReader
+from src.media_cache import MediaCache
+from src.menu import Menu, MenuNode
+from src.metrics import registry, handler_seconds, handler_errors, start_metrics_server
+from src.notifications import ChangeNotifier
+from src.outbound import OutboundQueue
+from src.profiler import SamplingProfiler, SlowUpdateRecorder, add_phase
+from src.render_state import RenderStateStore, render_hash
+from src.resilience import CircuitOpenError
+from src.screens import Screens
+from src.session_cache import SessionCache
+from src.startup import StartupReport
+from src.telegram_request import InstrumentedRequest
+from src.usage_stats import UsageRollup
+from src.users import UserRepository
+from src.webhook import WebhookServer, check_secret_token
+from src.workers import ChatWorkerPool
+from src.activity_log import ActivityLogArchiver, ActivityLogWriter
 from src.database import Database
+from src.employees import EmployeeRepository
+from src.exchange_rates import ExchangeRateCache
 
 from telegram.ext import Updater, MessageHandler, Filters, Handler
 from telegram.ext import CommandHandler, CallbackQueryHandler, DispatcherHandlerStop
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup, ChatAction
+from telegram import KeyboardButton, ReplyKeyboardMarkup, ChatAction
+from telegram import Bot as TelegramBot
 from telegram.error import (TelegramError, Unauthorized, BadRequest, TimedOut, ChatMigrated, NetworkError)
 import config as config_global
 import env
-from src.utils import get_exchange_rate
+from src.utils import normalize_phone_number
 from functools import wraps
 
+logger = logging.getLogger(__name__)
+
 
 def send_typing_action(func):
     """Sends typing action while processing func command."""
@@ -28,22 +57,95 @@ def send_typing_action(func):
     return command_func
 
 
-def build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
-    menu = [buttons[i:i + n_cols] for i in range(0, len(buttons), n_cols)]
-    if header_buttons:
-        menu.insert(0, header_buttons)
-    if footer_buttons:
-        menu.append(footer_buttons)
-    return menu
+def classify_error(error):
+    # Same classes as Bot.error_handler, subclasses first
+    for error_class in (Unauthorized, BadRequest, TimedOut, NetworkError, ChatMigrated, TelegramError):
+        if isinstance(error, error_class):
+            return error_class.__name__
+    return type(error).__name__
+
+
+def instrument_handler(group, callback):
+    """Wraps a handler callback to record its latency and errors"""
+    name = callback.__name__
+
+    @wraps(callback)
+    def instrumented(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return callback(*args, **kwargs)
+        except DispatcherHandlerStop:
+            raise  # control flow, not an error
+        except Exception as e:
+            handler_errors.inc(group, name, classify_error(e))
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            handler_seconds.observe(seconds, group, name)
+            add_phase(f'handler {group} {name}', seconds)
+
+    return instrumented
 
 
 # telegram examples: https://github.com/python-telegram-bot/python-telegram-bot/wiki/Code-snippets
 class Bot:
-    def __init__(self):
-        self.__db = Database('database.db')
-        self.__updater = Updater(token=env.telegram_bot_token)  # Токен API к Telegram
-        self.__dispatcher = self.__updater.dispatcher
-        self.__gsheet = GoogleSpreadsheetReader()
+    def __init__(self, db_path='database.db', token=None, gsheet=None, startup=None):
+        self.__startup = startup or StartupReport()
+        with self.__startup.phase('database'):
+            self.__db = Database(db_path)
+        self.__activity_log = ActivityLogWriter(self.__db, **config_global.activity_log)
+        self.__activity_log.start()
+        retention = config_global.activity_log_retention
+        self.__activity_log_archiver = ActivityLogArchiver(
+            self.__db,
+            archive_dir=retention['archive_dir'],
+            retention_days=retention['retention_days'],
+            chunk_size=retention['chunk_size'],
+            chunk_pause_ms=retention['chunk_pause_ms']
+        )
+        self.__usage = UsageRollup(self.__db, batch_size=config_global.usage_rollup['batch_size'])
+        with self.__startup.phase('telegram'):
+            # Один пул соединений на все потоки: диспетчер, фоновые ответы и очередь отправки
+            request = InstrumentedRequest(con_pool_size=config_global.workers['size'] + 4)
+            telegram_bot = TelegramBot(
+                token or env.telegram_bot_token,  # Токен API к Telegram
+                base_url=getattr(env, 'telegram_base_url', None),
+                request=request
+            )
+            self.__updater = Updater(bot=telegram_bot)
+            self.__dispatcher = self.__updater.dispatcher
+        self.__gsheet = gsheet or GoogleSpreadsheetReader()
+        self.__employees = EmployeeRepository(self.__db)
+        self.__users = UserRepository(self.__db)
+        # Handlers read employees from SQLite, so the bot keeps serving when Google is slow or down
+        self.__gsheet.add_refresh_listener(self.sync_employees)
+        self.__exchange_rates = ExchangeRateCache(self.__db)
+        self.__sessions = SessionCache(**config_global.sessions)
+        self.__last_employee_sync = None
+        self.__media = MediaCache(self.__db)
+        self.__render_state = RenderStateStore(**config_global.render_state)
+        self.__workers = ChatWorkerPool(config_global.workers['size'])
+        self.__outbound = OutboundQueue(**config_global.outbound)
+        self.__outbound.start()
+        self.__change_notifier = ChangeNotifier(self.__users, self.__outbound)
+        with self.__startup.phase('screens'):
+            self.__menu = self.build_menu_tree()
+            builders = {
+                f'{name}_keyboard': functools.partial(self.__menu.keyboard, name)
+                for name, node in self.__menu.nodes.items() if node.has_keyboard
+            }
+            builders['authenticate_keyboard'] = self.build_authenticate_keyboard
+            builders['paid_day_offs_text'] = self.build_paid_day_offs_text
+            self.__screens = Screens(builders)
+        with self.__startup.phase('handlers'):
+            self.register_handlers()
+        self.__profiler = SamplingProfiler(config_global.profiling['interval_ms'] / 1000)
+        self.__slow_updates = SlowUpdateRecorder(**config_global.slow_updates)
+        # Polling, webhook and shard processes all hand updates to dispatcher.process_update
+        self.__dispatcher.process_update = self.__slow_updates.wrap(self.__dispatcher.process_update)
+        self.register_metrics()
+
+    def register_handlers(self):
         handlers = self.get_handlers()
 
         self.__dispatcher.add_handler(CommandHandler('start', self.logger), -2)
@@ -58,25 +160,105 @@ class Bot:
         for handler in handlers:
             self.__dispatcher.add_handler(handler, 0)
 
+        for group, group_handlers in self.__dispatcher.handlers.items():
+            for handler in group_handlers:
+                handler.callback = instrument_handler(group, handler.callback)
+        for node in self.__menu.nodes.values():
+            if node.handler is not None:
+                node.handler = instrument_handler('menu', node.handler)
+
+    @property
+    def dispatcher(self):
+        return self.__dispatcher
+
+    @property
+    def job_queue(self):
+        return self.__updater.job_queue
+
+    def register_metrics(self):
+        # Gauges are read on scrape, so they cost nothing between scrapes
+        def stats_gauge(name, help, stats):
+            registry.gauge(name, help, ('stat',), lambda: {(key,): value for key, value in stats().items()})
+
+        stats_gauge('bot_activity_log', 'Activity log writer queue and counters', self.__activity_log.stats)
+        stats_gauge('bot_outbound', 'Outbound queue sizes and counters', self.__outbound.stats)
+        stats_gauge('bot_sessions', 'Session cache size and counters', self.__sessions.stats)
+        stats_gauge('bot_render_state', 'Skipped and sent message edits', self.__render_state.stats)
+        stats_gauge('bot_workers', 'Chats with background answers running or queued', self.__workers.stats)
+        stats_gauge('bot_slow_updates', 'Updates processed and slower than the threshold', self.__slow_updates.stats)
+        registry.gauge(
+            'bot_startup_seconds',
+            'Duration of startup phases',
+            ('phase',),
+            lambda: {(name,): seconds for name, seconds in self.__startup.phases}
+        )
+
     def logger(self, bot, update):
         user_id = self.get_chat_id_by_update(update)
         message = self.get_message_by_update(update)
         callback = self.get_callback_by_update(update)
         now = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=2)  # UTC + 2
-        self.__db.execute(
-            """
-                INSERT INTO activity_log(user_id, callback, message, update_query, when_created)
-                VALUES(?, ?, ?, ?, ?)
-            """,
+        self.__activity_log.log(
             user_id,
             callback,
             message,
-            str(update),
+            update,
             now.strftime('%Y-%m-%d %H:%M:%S')
         )
 
 
+    def sync_employees(self, snapshot):
+        stats = self.__employees.sync(snapshot.records)
+        if stats['rows_updated'] or stats['rows_deleted']:
+            self.__sessions.clear()  # cached users may no longer match the spreadsheet
+        if stats['changes'] and config_global.change_notifications['enabled']:
+            # A full broadcast lane blocks the sender, the refresher shouldn't wait for it
+            threading.Thread(
+                target=self.__change_notifier.notify,
+                args=(self.__updater.bot, stats['changes']),
+                name='change-notifier',
+                daemon=True
+            ).start()
+
+    def follow_employee_sync(self, bot, job):
+        # Another process synced the employees: cached users may no longer match, same as in sync_employees()
+        last_sync = self.__employees.last_sync()
+        if last_sync is None or last_sync['when_started'] == self.__last_employee_sync:
+            return
+        if self.__last_employee_sync is not None and (last_sync['rows_updated'] or last_sync['rows_deleted']):
+            self.__sessions.clear()
+        self.__last_employee_sync = last_sync['when_started']
+
+    def expire_authorizations(self, bot, job):
+        self.__users.expire_authorizations()
+
+    def reload_screens(self, bot, job):
+        self.__screens.reload_if_changed()
+
+    def roll_up_usage(self, bot, job):
+        self.__usage.catch_up()
+
+    def archive_activity_log(self, bot, job):
+        def archive():
+            self.__usage.catch_up()  # archived rows must be counted first
+            self.__activity_log_archiver.run()
+
+        # Can take minutes on a large log, other jobs shouldn't wait for it
+        threading.Thread(target=archive, name='activity-log-archiver', daemon=True).start()
+
+    def prefetch_exchange_rates(self, bot, job):
+        self.__exchange_rates.prefetch(datetime.datetime.today())
+
+    def send_message(self, bot, **kwargs):
+        # Goes through the outbound queue to stay within Telegram flood limits
+        self.__outbound.send(bot.send_message, **kwargs)
+
+    def is_admin(self, user_id):
+        return user_id in getattr(env, 'admin_user_ids', [])
+
     def error_handler(self, bot, update, error):
+        if isinstance(error, BadRequest) and 'message is not modified' in str(error).lower():
+            return  # the message already shows what the user asked for
         chat_id = self.get_chat_id_by_update(update)
         error_message = 'error: '
         try:
@@ -100,59 +282,13 @@ class Bot:
             # handle all other telegram related errors
             error_message += 'TelegramError'
 
-        bot.send_message(
+        self.send_message(
+            bot,
             chat_id=chat_id,
             text=error_message
         )
 
 
-    def get_db_user(self, phone_number='', first_name='', last_name='', user_id=''):
-        result = self.__db.execute(
-            """
-                SELECT 
-                    users.user_id,
-                    users.phone_number,
-                    users.first_name,
-                    users.last_name
-                FROM users
-                WHERE 1=1
-                    AND (
-                        users.phone_number = ?
-                        OR users.first_name = ?
-                        OR users.last_name = ?
-                        OR users.user_id = ?
-                    )         
-            """,
-            phone_number,
-            first_name,
-            last_name,
-            user_id
-        ).fetchall()
-
-        if len(result):
-            for row in result:
-                return {
-                    'user_id': row['user_id'],
-                    'phone_number': row['phone_number'],
-                    'first_name': row['first_name'],
-                    'last_name': row['last_name']
-                }
-
-        return None
-
-    def is_user_authenticated(self, user_id):
-        result = self.__db.execute(
-            """
-                SELECT users.user_id
-                FROM users
-                WHERE 1=1
-                    AND users.user_id = ?
-                    AND users.when_authorized > date('now','-7 days')            
-            """,
-            user_id
-        ).fetchall()
-        return len(result) != 0
-
     def get_message_by_update(self, update):
         try:
             message = update['message']['text']
@@ -179,22 +315,32 @@ class Bot:
 
     def check_user_auth_handler(self, bot, update):
         user_id = chat_id = self.get_chat_id_by_update(update)
+        if self.__sessions.get(chat_id) is not None:
+            return
 
-        db_user = self.get_db_user(user_id=user_id)
-        user_is_authenticated = False if db_user is None else self.is_user_authenticated(user_id)
+        db_user = self.__users.get_by_id(user_id)
+        authorized_until = None if db_user is None else self.__users.get_authorized_until(user_id)
+        user_is_authenticated = authorized_until is not None
 
+        employee = None
         if db_user is not None:
-            spreadsheet_record = self.__gsheet.get_record_by_condition('Name', db_user['first_name'] + ' ' + db_user['last_name'])  # By name
+            employee = self.__employees.get_by_name(db_user['first_name'] + ' ' + db_user['last_name'])
 
-        if not user_is_authenticated or self.get_db_user(phone_number=spreadsheet_record['Phone number']) is None:
-            bot.send_message(
+        if not user_is_authenticated or employee is None or self.__users.get_by_phone_number(employee['phone_number']) is None:
+            self.send_message(
+                bot,
                 chat_id=chat_id,
                 text='Authentication required',
                 reply_markup=self.authenticate_keyboard()
             )
             raise DispatcherHandlerStop
 
+        self.__sessions.put(chat_id, db_user, authorized_until)
+
     def authenticate_keyboard(self):
+        return self.__screens['authenticate_keyboard']
+
+    def build_authenticate_keyboard(self):
         keyboard = [
             [KeyboardButton('Authenticate', request_contact=True, callback_data='authenticate')]
         ]
@@ -203,21 +349,53 @@ class Bot:
 
     @send_typing_action
     def start_handler(self, bot, update):
-        update.message.reply_text(
-            'Authentication required',
+        self.send_message(
+            bot,
+            chat_id=update.message.chat_id,
+            text='Authentication required',
             reply_markup=self.authenticate_keyboard()
         )
 
     def main_menu_handler(self, bot, update):
-        query = update.callback_query
-        bot.edit_message_text(
-            chat_id=query.message.chat_id,
-            message_id=query.message.message_id,
+        self.edit_message_text(
+            bot,
+            update.callback_query,
             text=self.main_menu_message(),
             reply_markup=self.main_menu_keyboard()
         )
         raise DispatcherHandlerStop
 
+    def edit_message_text(self, bot, query, text, reply_markup=None, parse_mode=None):
+        '''
+        Edits the message of the callback query, unless it already shows this text and keyboard:
+        then the query is only answered, Telegram would reject the edit with "message is not modified".
+        Edits go through the outbound queue like messages. Answers to callback queries don't: they aren't messages
+        to the chat, and the button keeps spinning until its answer reaches Telegram.
+        '''
+        chat_id = query.message.chat_id
+        message_id = query.message.message_id
+        content_hash = render_hash(text, reply_markup, parse_mode)
+        if self.__render_state.is_unchanged(chat_id, message_id, content_hash):
+            bot.answer_callback_query(callback_query_id=query.id)
+            return
+
+        def edit(**kwargs):
+            try:
+                bot.edit_message_text(**kwargs)
+            except BadRequest as e:
+                if 'message is not modified' not in str(e).lower():
+                    raise
+            self.__render_state.put(chat_id, message_id, content_hash)
+
+        self.__outbound.send(
+            edit,
+            chat_id=chat_id,
+            message_id=message_id,
+            text=text,
+            parse_mode=parse_mode,
+            reply_markup=reply_markup
+        )
+
     def get_emoji(self, emoji):
         return config_global.emojis[emoji]
 
@@ -237,215 +415,429 @@ class Bot:
     def authenticate_handler(self, bot, update):
         contact = update.message.contact
         chat_id = update.message.chat.id
-        spreadsheet_record = self.__gsheet.get_record_by_condition('Phone number', contact.phone_number)
+        employee = self.__employees.get_by_phone_number(contact.phone_number)
 
-        existing_user_by_phone_number = self.get_db_user(phone_number=contact.phone_number)
+        existing_user_by_phone_number = self.__users.get_by_phone_number(contact.phone_number)
 
         # If phone number not found in spreadsheet or someone else is trying to access data of other user
-        if spreadsheet_record is None or (existing_user_by_phone_number is not None and existing_user_by_phone_number['user_id'] != chat_id):
-            bot.send_message(
+        if employee is None or (existing_user_by_phone_number is not None and existing_user_by_phone_number['user_id'] != chat_id):
+            self.send_message(
+                bot,
                 chat_id=chat_id,
                 text='Access denied'
             )
             raise DispatcherHandlerStop
         # Change phone number how-to: https://telegram.org/blog/telegram-me-change-number-and-pfs
 
-        spreadsheet_record_full_name = str(spreadsheet_record['Name']).strip()
+        spreadsheet_record_full_name = employee['name']
         try:
             spreadsheet_record_first_name, spreadsheet_record_last_name = spreadsheet_record_full_name.split()
         except ValueError:
-            bot.send_message(
+            self.send_message(
+                bot,
                 chat_id=chat_id,
                 text=f'Invalid name format. Expected <Name Surname>, got <{spreadsheet_record_full_name}>'
             )
             raise DispatcherHandlerStop
-        spreadsheet_record_phone_number = str(spreadsheet_record['Phone number']).strip()
-
-        if spreadsheet_record_phone_number == contact.phone_number:
-            if self.get_db_user(first_name=spreadsheet_record_first_name, last_name=spreadsheet_record_last_name) is None:
-                self.__db.execute(
-                    """
-                        INSERT INTO users(first_name, last_name, phone_number, user_id)
-                        VALUES(?, ?, ?, ?)
-                    """,
+        spreadsheet_record_phone_number = employee['phone_number']
+
+        if spreadsheet_record_phone_number == normalize_phone_number(contact.phone_number):
+            if self.__users.get_by_full_name(spreadsheet_record_first_name, spreadsheet_record_last_name) is None:
+                self.__users.create(
+                    contact.user_id,
                     spreadsheet_record_first_name,
                     spreadsheet_record_last_name,
-                    contact.phone_number,
-                    contact.user_id
+                    spreadsheet_record_phone_number
                 )
-                bot.send_message(
+                self.send_message(
+                    bot,
                     chat_id=chat_id,
                     text='You have been registered'
                 )
 
-            self.__db.execute(  # refresh user data
-                """
-                    UPDATE users
-                    SET 
-                        phone_number = ?,
-                        when_authorized = datetime('now')
-                    WHERE users.user_id = ?
-                """,
-                spreadsheet_record_phone_number,
-                chat_id
-            )
+            self.__users.authorize(chat_id, spreadsheet_record_phone_number)  # refresh user data
+            self.__sessions.invalidate(chat_id)
 
             '''
-            bot.send_message(
+            self.send_message(
+                bot,
                 chat_id=chat_id,
                 text=f'Received Contact: {contact}',
             )
             '''
-            bot.send_message(
+            self.send_message(
+                bot,
                 chat_id=chat_id,
                 text=self.main_menu_message(),
                 reply_markup=self.main_menu_keyboard()
             )
-            self.main_menu_handler(bot, update)
 
             raise DispatcherHandlerStop
 
 
     def day_offs_menu_handler(self, bot, update):
-        query = update.callback_query
-        bot.edit_message_text(
-            chat_id=query.message.chat_id,
-            message_id=query.message.message_id,
+        self.edit_message_text(
+            bot,
+            update.callback_query,
             text=self.main_menu_message(),
             reply_markup=self.day_offs_menu_keyboard()
         )
 
     def day_offs_mine_handler(self, bot, update):
-        db_user = self.get_db_user(user_id=update.callback_query.message.chat_id)
-        spreadsheet_record = self.__gsheet.get_record_by_condition(
-            'Phone number',
-            db_user['phone_number']
-        )
+        self.answer_in_background(bot, update, 'day_offs_mine', self.get_day_offs_mine_text)
 
-        text = f'You have {spreadsheet_record["Day-offs"]} day-offs left'
+    def get_day_offs_mine_text(self, chat_id):
+        db_user = self.__users.get_by_id(chat_id)
+        employee = self.__employees.get_by_phone_number(db_user['phone_number'])
 
-        query = update.callback_query
-        bot.answer_callback_query(callback_query_id=query.id, text=text, show_alert=True)
+        return f'You have {employee["day_offs"]} day-offs left'
 
     @send_typing_action
     def day_offs_paid_handler(self, bot, update):
-        query = update.callback_query
+        self.edit_message_text(
+            bot,
+            update.callback_query,
+            text=self.__screens['paid_day_offs_text'],
+            parse_mode='Markdown',
+            reply_markup=self.__screens['day_offs_paid_keyboard']
+        )
 
+    def build_paid_day_offs_text(self):
         this_year_day_offs = env.paid_day_offs
-        text = '*Paid day-offs:*\n' + '\n'.join(
+        return '*Paid day-offs:*\n' + '\n'.join(
             [f'{holiday} - {this_year_day_offs[holiday]}' for holiday in this_year_day_offs]
         )
 
-        bot.edit_message_text(
-            chat_id=query.message.chat_id,
-            message_id=query.message.message_id,
-            text=text,
-            parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(build_menu(buttons=[self.get_main_menu_button()], n_cols=1))
-        )
-
     @send_typing_action
     def help_handler(self, bot, update):
-        query = update.callback_query
-        text = env.help_text
-        bot.edit_message_text(
-            chat_id=query.message.chat_id,
-            message_id=query.message.message_id,
-            text=text,
+        self.edit_message_text(
+            bot,
+            update.callback_query,
+            text=env.help_text,
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(build_menu(buttons=[self.get_main_menu_button()], n_cols=1))
+            reply_markup=self.__screens['help_keyboard']
         )
 
 
     def salary_handler(self, bot, update):
-        db_user = self.get_db_user(user_id=update.callback_query.message.chat_id)
-        spreadsheet_record = self.__gsheet.get_record_by_condition(
-            'Phone number',
-            db_user['phone_number']
-        )
+        self.answer_in_background(bot, update, 'salary', self.get_salary_text)
 
-        query = update.callback_query
-        bot.answer_callback_query(callback_query_id=query.id, text=spreadsheet_record['Salary'], show_alert=True)
+    def get_salary_text(self, chat_id):
+        db_user = self.__users.get_by_id(chat_id)
+        employee = self.__employees.get_by_phone_number(db_user['phone_number'])
+
+        return employee['salary']
 
     def currency_handler(self, bot, update):
-        query = update.callback_query
+        self.answer_in_background(bot, update, 'currency', self.get_currency_text)
 
+    def get_currency_text(self, chat_id):
         try:
             today = datetime.datetime.today()
-            today_exchange_rate = get_exchange_rate(47, today)  # EUR
+            rate_date, today_exchange_rate = self.__exchange_rates.get_or_last_known(47, today)  # EUR
             last_day_of_prev_month = today.replace(day=1) - datetime.timedelta(days=1)
-            prev_month_exchange_rate = get_exchange_rate(47, last_day_of_prev_month)  # EUR
+            _, prev_month_exchange_rate = self.__exchange_rates.get_or_last_known(47, last_day_of_prev_month)  # EUR
             text = f"{prev_month_exchange_rate} -> {today_exchange_rate}"
-        except ConnectionError as e:
+            if rate_date.date() != today.date():
+                text += f" (rate of {rate_date:%d.%m.%Y}, today's rate is not available yet)"
+        except (OSError, CircuitOpenError) as e:
+            # requests' exceptions and socket timeouts are OSErrors
             text = "Could not connect to server. Try again later"
         except IndexError as e:
             text = "Error: unexpected API response. Please, contact responsible IT rep to fix this problem"
         except Exception as e:
             text = "Error. Please, contact responsible IT rep to fix this problem"
 
-        bot.answer_callback_query(callback_query_id=query.id, text=text, show_alert=True)
+        return text
+
+    def answer_in_background(self, bot, update, name, get_text):
+        '''
+        Answers the callback query with get_text(chat_id), computed in the chat's worker thread.
+        If the text isn't ready before the handler's deadline, the button is acknowledged right away
+        and the text is sent as a message once it's ready.
+        '''
+        query = update.callback_query
+        chat_id = query.message.chat_id
+        deadline = config_global.workers['deadlines'][name]
+
+        lock = threading.Lock()
+        state = {'done': False, 'acknowledged': False}
+
+        def acknowledge():
+            with lock:
+                if state['done']:
+                    return
+                state['acknowledged'] = True
+            bot.answer_callback_query(callback_query_id=query.id, text='Loading…')
+
+        def task():
+            try:
+                text = str(get_text(chat_id))
+            except Exception:
+                logger.exception(f'{name} failed for chat {chat_id}')
+                text = "Error. Please, contact responsible IT rep to fix this problem"
+            finally:
+                timer.cancel()
+
+            with lock:
+                state['done'] = True
+            if state['acknowledged']:
+                self.send_message(bot, chat_id=chat_id, text=text)
+            else:
+                bot.answer_callback_query(callback_query_id=query.id, text=text, show_alert=True)
+
+        # The deadline counts from now: while every worker is busy the task waits in the pool's queue
+        timer = threading.Timer(deadline, acknowledge)
+        timer.start()
+        self.__workers.submit(chat_id, task)
 
     @send_typing_action
     def about_us_handler(self, bot, update):
-        bot.send_photo(
+        # Uploads the logo once, then sends its file_id, within flood limits like any message
+        self.__outbound.send(
+            functools.partial(self.__media.send_photo, bot, 'assets/logo.png'),
             chat_id=update.callback_query.message.chat_id,
             caption=self.get_about_info(),
-            photo=open('assets/logo.png', 'rb'),
-            reply_markup=InlineKeyboardMarkup(build_menu(buttons=[self.get_website_link_button()], n_cols=1))
+            reply_markup=self.__screens['about_us_keyboard']
         )
 
     def main_menu_message(self):
         return 'Choose an option:'
 
-    @send_typing_action
-    def text_message_handler(self, bot, update):
-        bot.send_message(chat_id=update.message.chat_id, text="Direct messaging doesn't work yet")
+    def broadcast_handler(self, bot, update):
+        chat_id = update.message.chat_id
+        if not self.is_admin(update.message.from_user.id):
+            return
 
-    def main_menu_keyboard(self):
-        header_buttons = [
-            InlineKeyboardButton(self.get_emoji('palm_tree') + ' Day-offs', callback_data='day_offs_menu'),
-        ]
+        try:
+            text = update.message.text.split(None, 1)[1]
+        except IndexError:
+            self.send_message(bot, chat_id=chat_id, text='Usage: /broadcast <text>')
+            return
+
+        def broadcast():
+            count = self.__outbound.broadcast(bot, self.__users.iter_authorized_user_ids(), text)
+            stats = self.__outbound.stats()
+            self.send_message(
+                bot,
+                chat_id=chat_id,
+                text=f"Broadcast queued for {count} users, {stats['queue_broadcast']} waiting, {stats['per_second']:.1f} msg/s"
+            )
 
-        keyboard = [
-            InlineKeyboardButton(self.get_emoji('euro_banknote') + ' Salary', callback_data='salary'),
-            InlineKeyboardButton(self.get_emoji('chart_upwards') + ' Currency', callback_data='currency'),
-            InlineKeyboardButton(self.get_emoji('about') + ' About us', callback_data='about_us'),
-            InlineKeyboardButton(self.get_emoji('raised_hand') + ' Help', callback_data='help'),
-        ]
-        return InlineKeyboardMarkup(build_menu(buttons=keyboard, header_buttons=header_buttons, n_cols=2))
+        # Recipients are streamed into the queue as it drains, which takes a while
+        threading.Thread(target=broadcast, name='broadcast', daemon=True).start()
 
-    def day_offs_menu_keyboard(self):
-        keyboard = [
-            InlineKeyboardButton(self.get_emoji('airplane') + ' My day-offs', callback_data='day_offs_mine'),
-            InlineKeyboardButton(self.get_emoji('snowman') + ' Paid day-offs', callback_data='day_offs_paid'),
+    def stats_handler(self, bot, update):
+        chat_id = update.message.chat_id
+        if not self.is_admin(update.message.from_user.id):
+            return
+
+        # Reads only the rollups, activity_log itself is never scanned
+        today = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=2)  # UTC + 2, as in activity_log
+        lines = [f'Usage up to activity log row #{self.__usage.checkpoint()}']
+        last_day = sum(count for hour, count in self.__usage.get_hourly(today - datetime.timedelta(hours=23)))
+        lines.append(f'Last 24 hours: {last_day} actions')
+        for title, days in (('Today', 0), ('Last 7 days', 6), ('Last 30 days', 29)):
+            lines.append('')
+            lines.append(f'{title}:')
+            for action, count, users in self.__usage.get_daily(today - datetime.timedelta(days=days)):
+                lines.append(f'{action}: {count} times by {users} users')
+
+        self.send_message(bot, chat_id=chat_id, text='\n'.join(lines))
+
+    def profile_handler(self, bot, update):
+        chat_id = update.message.chat_id
+        if not self.is_admin(update.message.from_user.id):
+            return
+
+        try:
+            seconds = min(float(update.message.text.split()[1]), config_global.profiling['max_seconds'])
+        except (IndexError, ValueError):
+            self.send_message(bot, chat_id=chat_id, text=f"Usage: /profile <seconds>, at most {config_global.profiling['max_seconds']}")
+            return
+
+        def profile():
+            try:
+                samples, stacks = self.__profiler.profile(seconds)
+            except RuntimeError as e:
+                self.send_message(bot, chat_id=chat_id, text=str(e))
+                return
+            top = self.__profiler.top_functions(stacks, skip_threads=('MainThread',))
+            caption = f'{samples} samples in {seconds:g}s, most seen on top of a stack:\n' + '\n'.join(
+                f'{count} {function}' for function, count in top
+            )
+            self.__outbound.send(
+                bot.send_document,
+                chat_id=chat_id,
+                document=io.BytesIO(self.__profiler.format_collapsed(stacks).encode('utf-8')),
+                filename=f'profile-{datetime.datetime.now():%Y%m%d-%H%M%S}.txt',
+                caption=caption[:1024]
+            )
+
+        # Sampling takes `seconds`, the dispatcher keeps running meanwhile and is what gets profiled
+        threading.Thread(target=profile, name='profiler', daemon=True).start()
+
+    def slow_updates_handler(self, bot, update):
+        chat_id = update.message.chat_id
+        if not self.is_admin(update.message.from_user.id):
+            return
+
+        try:
+            limit = int(update.message.text.split()[1])
+        except (IndexError, ValueError):
+            limit = 10
+        stats = self.__slow_updates.stats()
+        lines = [
+            f"{stats['slow']} of {stats['processed']} updates took over "
+            f"{self.__slow_updates.threshold * 1000:g} ms, last {stats['kept']} kept"
         ]
-        return InlineKeyboardMarkup(build_menu(buttons=keyboard, footer_buttons=[self.get_main_menu_button()], n_cols=2))
+        for entry in self.__slow_updates.recent(limit):
+            lines.append('')
+            lines.append(f"{entry['when']} #{entry['update_id']} {entry['kind']} in chat {entry['chat_id']}: {entry['ms']} ms")
+            lines.extend(f'  {name}: {ms} ms' for name, ms in entry['phases'][:8])
+        self.send_message(bot, chat_id=chat_id, text='\n'.join(lines)[:4096])
+
+    def register_signal_handlers(self):
+        # kill -USR2 <pid> profiles this process for profiling['signal_seconds'], the dump goes to profiling['output_dir']
+        if hasattr(signal, 'SIGUSR2'):
+            signal.signal(signal.SIGUSR2, lambda signum, frame: threading.Thread(
+                target=self.profile_to_file, name='profiler', daemon=True
+            ).start())
+
+    def profile_to_file(self):
+        settings = config_global.profiling
+        try:
+            samples, stacks = self.__profiler.profile(settings['signal_seconds'])
+        except RuntimeError as e:
+            logger.warning(str(e))
+            return
+        os.makedirs(settings['output_dir'], exist_ok=True)
+        path = os.path.join(settings['output_dir'], f'profile-{os.getpid()}-{datetime.datetime.now():%Y%m%d-%H%M%S}.txt')
+        with open(path, 'w') as f:
+            f.write(self.__profiler.format_collapsed(stacks))
+        logger.info(f'Profile of {samples} samples written to {path}')
 
-    def get_main_menu_button(self):
-        return InlineKeyboardButton(self.get_emoji('back') + ' Main menu', callback_data='main')
+    @send_typing_action
+    def text_message_handler(self, bot, update):
+        self.send_message(bot, chat_id=update.message.chat_id, text="Direct messaging doesn't work yet")
 
-    def get_website_link_button(self):
-        return InlineKeyboardButton('Website', url=self.get_about_website())
+    def main_menu_keyboard(self):
+        return self.__screens['main_keyboard']
+
+    def day_offs_menu_keyboard(self):
+        return self.__screens['day_offs_menu_keyboard']
+
+    def build_menu_tree(self):
+        # Titles and links are read from config/env every time the screens are built
+        def title(emoji, text):
+            return lambda: self.get_emoji(emoji) + ' ' + text
+
+        return Menu([
+            MenuNode(
+                'main', title('back', 'Main menu'), self.main_menu_handler,
+                header=['day_offs_menu'], buttons=['salary', 'currency', 'about_us', 'help']
+            ),
+            MenuNode(
+                'day_offs_menu', title('palm_tree', 'Day-offs'), self.day_offs_menu_handler,
+                buttons=['day_offs_mine', 'day_offs_paid'], footer=['main']
+            ),
+            MenuNode('day_offs_mine', title('airplane', 'My day-offs'), self.day_offs_mine_handler),
+            MenuNode('day_offs_paid', title('snowman', 'Paid day-offs'), self.day_offs_paid_handler, footer=['main']),
+            MenuNode('salary', title('euro_banknote', 'Salary'), self.salary_handler),
+            MenuNode('currency', title('chart_upwards', 'Currency'), self.currency_handler),
+            MenuNode('about_us', title('about', 'About us'), self.about_us_handler, buttons=['website'], n_cols=1),
+            MenuNode('website', 'Website', url=self.get_about_website),
+            MenuNode('help', title('raised_hand', 'Help'), self.help_handler, footer=['main']),
+        ])
+
+    def callback_query_handler(self, bot, update):
+        return self.__menu.dispatch(bot, update)
 
     def get_handlers(self):
         return [
             MessageHandler(Filters.text, self.text_message_handler),
             CommandHandler('start', self.start_handler),
+            CommandHandler('broadcast', self.broadcast_handler),
+            CommandHandler('stats', self.stats_handler),
+            CommandHandler('profile', self.profile_handler),
+            CommandHandler('slow', self.slow_updates_handler),
             # CallbackQueryHandler(authenticate, pattern='authenticate'),
             MessageHandler(Filters.contact, self.authenticate_handler),
 
-            CallbackQueryHandler(self.main_menu_handler, pattern='main'),
-            CallbackQueryHandler(self.day_offs_menu_handler, pattern='day_offs_menu'),
-            CallbackQueryHandler(self.day_offs_mine_handler, pattern='day_offs_mine'),
-            CallbackQueryHandler(self.day_offs_paid_handler, pattern='day_offs_paid'),
-            CallbackQueryHandler(self.salary_handler, pattern='salary'),
-            CallbackQueryHandler(self.currency_handler, pattern='currency'),
-            CallbackQueryHandler(self.about_us_handler, pattern='about_us'),
-            CallbackQueryHandler(self.help_handler, pattern='help'),
+            # Every button is routed by the menu tree, see build_menu_tree()
+            CallbackQueryHandler(self.callback_query_handler),
         ]
 
     def idle(self):
-        # Начинаем поиск обновлений
-        self.__updater.start_polling(clean=True)
-        # Останавливаем бота, если были нажаты Ctrl + C
-        self.__updater.idle()
+        if config_global.webhook['enabled']:
+            check_secret_token(env.webhook_secret_token)  # before any job or thread is started
+        self.register_signal_handlers()
+        self.start_jobs()
+        if config_global.metrics['enabled']:
+            start_metrics_server(config_global.metrics['listen'], config_global.metrics['port'])
+        if config_global.webhook['enabled']:
+            self.serve_webhook()
+        else:
+            with self.__startup.phase('polling'):
+                # Начинаем поиск обновлений
+                self.__updater.start_polling(clean=True)
+            self.__startup.log()
+            # Останавливаем бота, если были нажаты Ctrl + C
+            self.__updater.idle()
+        self.close()
+
+    def start_jobs(self, primary=True):
+        """
+        Starts background jobs. With several bot processes (see src/sharding.py) only the primary one
+        syncs the spreadsheet and runs jobs writing to the shared database, the others follow its syncs.
+        """
+        job_queue = self.__updater.job_queue
+        job_queue.run_repeating(self.reload_screens, config_global.screens['reload_interval'])
+        if primary:
+            with self.__startup.phase('spreadsheet snapshot'):
+                # The copy saved by the previous run is served while the refresher downloads the sheet again
+                self.__gsheet.load_saved()
+            self.__gsheet.start_refresher()
+            job_queue.run_once(self.prefetch_exchange_rates, 0)
+            job_queue.run_repeating(self.expire_authorizations, config_global.users['expire_interval'], first=0)
+            job_queue.run_daily(self.prefetch_exchange_rates, config_global.exchange_rates['prefetch_time'])
+            job_queue.run_repeating(self.roll_up_usage, config_global.usage_rollup['interval'])
+            job_queue.run_daily(self.archive_activity_log, config_global.activity_log_retention['run_time'])
+        else:
+            job_queue.run_repeating(self.follow_employee_sync, config_global.sharding['sync_check_interval'], first=0)
+        job_queue.start()
+
+    def close(self):
+        # Finishes background work: pending answers, queued messages and activity log rows
+        self.__workers.shutdown()
+        self.__outbound.stop()
+        self.__activity_log.close()
+
+    def serve_webhook(self):
+        webhook = WebhookServer(
+            self.__updater.bot,
+            self.__dispatcher,
+            env.webhook_secret_token,
+            listen=config_global.webhook['listen'],
+            port=config_global.webhook['port'],
+            path=config_global.webhook['path']
+        )
+        webhook.add_get_route('/metrics', lambda: (200, 'text/plain; version=0.0.4; charset=utf-8', registry.render()))
+        with self.__startup.phase('webhook'):
+            self.__updater.job_queue.start()
+            threading.Thread(target=self.__dispatcher.start, name='dispatcher', daemon=True).start()
+            webhook.start()
+            webhook.set_webhook(env.webhook_url)
+        self.__startup.log()
+
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+            signal.signal(signum, lambda signum, frame: stop.set())
+        while not stop.wait(1):
+            pass
+
+        # Graceful shutdown: refuse new updates, let the dispatcher take the queued ones, then stop
+        webhook.drain(config_global.webhook['drain_timeout'])
+        self.__dispatcher.stop()
+        self.__updater.job_queue.stop()
+        webhook.stop()
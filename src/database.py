@@ -1,59 +1,145 @@
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from src.metrics import registry
+from src.migrations import MIGRATIONS
+from src.profiler import add_phase
+
+sqlite_seconds = registry.histogram('bot_sqlite_seconds', 'SQLite statement and transaction latency', ('kind',))
 
 
 class Database:
+    """
+    One serialized writer connection plus one read connection per thread.
+    In WAL mode readers never block the writer and vice versa.
+    Read connections of threads that have finished are closed whenever a new one is opened.
+    """
+
+    PRAGMAS = [
+        'PRAGMA synchronous = NORMAL',  # safe with WAL, skips an fsync per commit
+        'PRAGMA cache_size = -8192',  # KiB
+        'PRAGMA temp_store = MEMORY',
+        'PRAGMA busy_timeout = 5000',
+    ]
+    CACHED_STATEMENTS = 256
+
     def __init__(self, path):
-        self.__con = sqlite3.connect(path, check_same_thread=False)
-        self.__con.row_factory = sqlite3.Row
-        self.__cur = self.__con.cursor()
-        self.init_dables()
+        self.__path = path
+        self.__local = threading.local()
+        self.__lock = threading.RLock()
+        self.__readers = {}  # threading.Thread -> its read connection
+        self.__readers_lock = threading.Lock()
+        self.__writer = self.__connect()
+        self.__writer.execute('PRAGMA journal_mode = WAL')
+        if self.__writer.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            # Lets incremental_vacuum() give back pages of deleted rows. Switching rebuilds the file, once
+            self.__writer.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            self.__writer.execute('VACUUM')
+        self.migrate()
+
+    def __connect(self):
+        # isolation_level=None: autocommit, transactions are opened explicitly by transaction()/snapshot()
+        con = sqlite3.connect(
+            self.__path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=self.CACHED_STATEMENTS
+        )
+        con.row_factory = sqlite3.Row
+        for pragma in self.PRAGMAS:
+            con.execute(pragma)
+        return con
+
+    @property
+    def __reader(self):
+        con = getattr(self.__local, 'reader', None)
+        if con is None:
+            with self.__readers_lock:
+                # Short-lived threads (broadcasts, notifications, archiving) would otherwise leave one open each
+                for thread in [thread for thread in self.__readers if not thread.is_alive()]:
+                    self.__readers.pop(thread).close()
+                con = self.__local.reader = self.__readers[threading.current_thread()] = self.__connect()
+        return con
+
+    @staticmethod
+    def is_read_only(sql):
+        return sql.lstrip().split(None, 1)[0].upper() in ('SELECT', 'WITH')
 
     def execute(self, sql, *args):
-        self.__cur.execute(sql, args)
-        self.__con.commit()
-        return self.__cur
-
-    def init_dables(self):
-        sql_init_users = """
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY UNIQUE NOT NULL, 
-                first_name VARCHAR(40) NOT NULL,
-                last_name VARCHAR(40) NOT NULL,
-                phone_number VARCHAR(40) NOT NULL,
-                when_authorized DATETIME 
-            );
-        """
-        self.execute(sql_init_users)
-
-        sql_init_activity_log = """
-            CREATE TABLE IF NOT EXISTS activity_log (
-                id INTEGER PRIMARY KEY ASC AUTOINCREMENT UNIQUE NOT NULL,
-                user_id INTEGER NOT NULL DEFAULT 0,
-                callback VARCHAR(40),
-                message TEXT,
-                update_query TEXT,
-                when_created DATETIME NOT NULL
-            );
-        """
-        self.execute(sql_init_activity_log)
-
-        # Unauthorize users who exceed max authoization timespan
-        sql_refresh_users = """
-            UPDATE users
-            SET users.when_authorized = NULL
-            WHERE users.when_authorized < date('now','-7 days')
-        """
-        self.execute(sql_init_users)
+        started = time.perf_counter()
+        # Reads inside this thread's write transaction must see its uncommitted rows
+        if self.is_read_only(sql) and not getattr(self.__local, 'transaction_depth', 0):
+            cur = self.__reader.execute(sql, args)
+            seconds = time.perf_counter() - started
+            sqlite_seconds.observe(seconds, 'read')
+            add_phase('sqlite read', seconds)
+            return cur
 
-    def __del__(self):
-        self.__con.close()
+        with self.__lock:
+            cur = self.__writer.execute(sql, args)
+        seconds = time.perf_counter() - started
+        sqlite_seconds.observe(seconds, 'write')
+        add_phase('sqlite write', seconds)
+        return cur
+
+    @contextmanager
+    def transaction(self):
+        """Write transaction on the writer connection, committed on exit and rolled back on error"""
+        with self.__lock, sqlite_seconds.time('transaction'):
+            depth = getattr(self.__local, 'transaction_depth', 0)
+            cur = self.__writer.cursor()
+            if depth == 0:
+                cur.execute('BEGIN IMMEDIATE')
+            self.__local.transaction_depth = depth + 1
+            try:
+                yield cur
+            except Exception:
+                if depth == 0:
+                    cur.execute('ROLLBACK')
+                raise
+            else:
+                if depth == 0:
+                    cur.execute('COMMIT')
+            finally:
+                self.__local.transaction_depth = depth
+                cur.close()
 
+    @contextmanager
+    def snapshot(self):
+        """Consistent read-only view for several SELECTs on this thread's read connection"""
+        cur = self.__reader.cursor()
+        cur.execute('BEGIN DEFERRED')
+        try:
+            yield cur
+        finally:
+            cur.execute('COMMIT')
+            cur.close()
 
-'''
-cur.execute('INSERT INTO users (...) VALUES(...)')
-con.commit()
-print(cur.lastrowid)
-cur.execute('SELECT * FROM ...')
-print(cur.fetchall())
-'''
+    def migrate(self):
+        with self.__lock:
+            version = self.__writer.execute('PRAGMA user_version').fetchone()[0]
+            for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+                try:
+                    self.__writer.executescript(f'BEGIN IMMEDIATE; {script}; PRAGMA user_version = {number}; COMMIT;')
+                except Exception:
+                    if self.__writer.in_transaction:
+                        self.__writer.execute('ROLLBACK')
+                    raise
 
+    def incremental_vacuum(self, pages=None):
+        """Returns up to `pages` free pages (all of them by default) to the file system"""
+        with self.__lock:
+            # Every step of the statement frees one page, so it must be read to the end
+            self.__writer.execute(f'PRAGMA incremental_vacuum({int(pages) if pages else 0})').fetchall()
+
+    def close(self):
+        with self.__readers_lock:
+            for con in self.__readers.values():
+                con.close()
+            self.__readers = {}
+        self.__writer.close()
+
+    def __del__(self):
+        self.close()
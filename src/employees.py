@@ -0,0 +1,149 @@
+import datetime
+import hashlib
+import json
+import time
+
+from src.utils import normalize_phone_number
+
+
+class EmployeeRepository:
+    """SQLite mirror of the employee spreadsheet, kept up to date by sync()"""
+
+    # spreadsheet column -> employees column
+    COLUMNS = {
+        'Name': 'name',
+        'Phone number': 'phone_number',
+        'Salary': 'salary',
+        'Day-offs': 'day_offs',
+    }
+    # employees column -> index in row_from_record(), employees are told when these change
+    NOTIFIED_COLUMNS = {
+        'salary': 2,
+        'day_offs': 3,
+    }
+
+    def __init__(self, db):
+        self.__db = db
+
+    def get_by_phone_number(self, phone_number):
+        return self.__db.execute(
+            """
+                SELECT employees.name, employees.phone_number, employees.salary, employees.day_offs
+                FROM employees
+                WHERE employees.phone_number = ?
+            """,
+            normalize_phone_number(phone_number)
+        ).fetchone()
+
+    def get_by_name(self, name):
+        return self.__db.execute(
+            """
+                SELECT employees.name, employees.phone_number, employees.salary, employees.day_offs
+                FROM employees
+                WHERE employees.name = ?
+                LIMIT 1
+            """,
+            ' '.join(str(name).split())
+        ).fetchone()
+
+    @staticmethod
+    def row_from_record(record):
+        return (
+            ' '.join(str(record.get('Name', '')).split()),
+            normalize_phone_number(record.get('Phone number', '')),
+            str(record.get('Salary', '')),
+            str(record.get('Day-offs', '')),
+        )
+
+    @staticmethod
+    def row_hash(row):
+        return hashlib.sha1(json.dumps(row).encode('utf-8')).hexdigest()
+
+    def sync(self, records):
+        """
+        Writes only inserted, changed and deleted rows, in a single transaction.
+        Returns the sync stats, plus 'changes': the NOTIFIED_COLUMNS that changed in updated rows,
+        as a list of {'phone_number': ..., 'fields': {'salary': new value, ...}}.
+        """
+        started = time.monotonic()
+        when_started = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+        rows = {}
+        for record in records:
+            row = self.row_from_record(record)
+            if row[1] and row[1] not in rows:  # rows without phone number can't be looked up
+                rows[row[1]] = row
+
+        with self.__db.transaction() as cur:
+            existing = {
+                row['phone_number']: row
+                for row in cur.execute('SELECT phone_number, salary, day_offs, row_hash FROM employees').fetchall()
+            }
+
+            inserted, updated, changes = [], [], []
+            for phone_number, row in rows.items():
+                row_hash = self.row_hash(row)
+                if phone_number not in existing:
+                    inserted.append(row + (row_hash, when_started))
+                elif existing[phone_number]['row_hash'] != row_hash:
+                    updated.append(row[:1] + row[2:] + (row_hash, when_started, phone_number))
+                    fields = {
+                        column: row[index]
+                        for column, index in self.NOTIFIED_COLUMNS.items()
+                        if existing[phone_number][column] != row[index]
+                    }
+                    if fields:
+                        changes.append({'phone_number': phone_number, 'fields': fields})
+            deleted = [(phone_number,) for phone_number in existing if phone_number not in rows]
+
+            cur.executemany(
+                """
+                    INSERT INTO employees(name, phone_number, salary, day_offs, row_hash, when_synced)
+                    VALUES(?, ?, ?, ?, ?, ?)
+                """,
+                inserted
+            )
+            cur.executemany(
+                """
+                    UPDATE employees
+                    SET
+                        name = ?,
+                        salary = ?,
+                        day_offs = ?,
+                        row_hash = ?,
+                        when_synced = ?
+                    WHERE employees.phone_number = ?
+                """,
+                updated
+            )
+            cur.executemany('DELETE FROM employees WHERE employees.phone_number = ?', deleted)
+
+            stats = {
+                'when_started': when_started,
+                'duration_ms': int((time.monotonic() - started) * 1000),
+                'rows_total': len(rows),
+                'rows_inserted': len(inserted),
+                'rows_updated': len(updated),
+                'rows_deleted': len(deleted),
+            }
+            cur.execute(
+                """
+                    INSERT INTO employees_sync_log(when_started, duration_ms, rows_total, rows_inserted, rows_updated, rows_deleted)
+                    VALUES(:when_started, :duration_ms, :rows_total, :rows_inserted, :rows_updated, :rows_deleted)
+                """,
+                stats
+            )
+
+        stats['changes'] = changes
+        return stats
+
+    def last_sync(self):
+        row = self.__db.execute(
+            """
+                SELECT when_started, duration_ms, rows_total, rows_inserted, rows_updated, rows_deleted
+                FROM employees_sync_log
+                ORDER BY id DESC
+                LIMIT 1
+            """
+        ).fetchone()
+        return None if row is None else dict(row)
@@ -0,0 +1,84 @@
+import datetime
+import logging
+
+from src.single_flight import SingleFlight
+from src.utils import get_exchange_rates
+
+logger = logging.getLogger(__name__)
+
+
+class ExchangeRateCache:
+    """Official rates never change once published, so they are fetched once and kept in SQLite"""
+
+    def __init__(self, db, fetch=get_exchange_rates):
+        self.__db = db
+        self.__fetch = fetch
+        self.__flight = SingleFlight('exchange_rates_prefetch')
+
+    def prefetch(self, date):
+        """Fetches and stores every rate of the date, concurrent calls for the same date share one"""
+        return self.__flight.do(date.strftime('%Y-%m-%d'), self.__prefetch, date)
+
+    def __prefetch(self, date):
+        rates = self.__fetch(date)
+        with self.__db.transaction() as cur:
+            cur.executemany(
+                """
+                    INSERT OR REPLACE INTO exchange_rates(date, currency_id, char_code, nominal, value)
+                    VALUES(?, ?, ?, ?, ?)
+                """,
+                [
+                    (date.strftime('%Y-%m-%d'), currency_id, rate['char_code'], rate['nominal'], rate['value'])
+                    for currency_id, rate in rates.items()
+                ]
+            )
+        return len(rates)
+
+    def get_cached(self, currency_id, date):
+        row = self.__db.execute(
+            """
+                SELECT exchange_rates.value
+                FROM exchange_rates
+                WHERE exchange_rates.date = ?
+                    AND exchange_rates.currency_id = ?
+            """,
+            date.strftime('%Y-%m-%d'),
+            currency_id
+        ).fetchone()
+        return None if row is None else row['value']
+
+    def get(self, currency_id, date):
+        value = self.get_cached(currency_id, date)
+        if value is None:  # not prefetched yet
+            self.prefetch(date)
+            value = self.get_cached(currency_id, date)
+        if value is None:
+            raise IndexError(f'Currency {currency_id} is missing for {date:%Y-%m-%d}')
+        return value
+
+    def get_or_last_known(self, currency_id, date):
+        """Returns (date, value) of the date or, if it can't be fetched, of the latest stored day before it"""
+        try:
+            return date, self.get(currency_id, date)
+        except Exception as e:
+            row = self.__db.execute(
+                """
+                    SELECT exchange_rates.date, exchange_rates.value
+                    FROM exchange_rates
+                    WHERE exchange_rates.currency_id = ?
+                        AND exchange_rates.date < ?
+                    ORDER BY exchange_rates.date DESC
+                    LIMIT 1
+                """,
+                currency_id,
+                date.strftime('%Y-%m-%d')
+            ).fetchone()
+            if row is None:
+                raise
+            logger.warning(f"Serving the rate of {row['date']} for {date:%Y-%m-%d}: {type(e).__name__}: {e}")
+            return datetime.datetime.strptime(row['date'], '%Y-%m-%d'), row['value']
+
+    def get_range(self, currency_id, start, end):
+        """Returns [(date, value), ...] for every day from start to end inclusive, fetching missing days"""
+        days = [start + datetime.timedelta(days=i) for i in range((end - start).days + 1)]
+        return [(day, self.get(currency_id, day)) for day in days]
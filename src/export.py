@@ -0,0 +1,165 @@
+import argparse
+import csv
+import datetime
+import gzip
+import json
+import os
+import sqlite3
+import sys
+from urllib.request import pathname2url
+
+sys.path.append("../")
+
+from src.activity_log import decode_payload
+
+'''
+Streams activity_log or users to gzipped CSV or JSON lines, in constant memory:
+
+    python src/export.py activity_log --since 2020-01-01 --until 2020-02-01 --format csv
+    python src/export.py activity_log --user-id 12345 --output user-12345.jsonl.gz
+    python src/export.py users --format csv
+
+Incremental exports: every run continues after the last id exported by the previous one
+    python src/export.py activity_log --checkpoint activity_log.checkpoint
+'''
+
+# table -> (id column, date column filtered by --since/--until, exported columns)
+TABLES = {
+    'activity_log': (
+        'id',
+        'when_created',
+        ['id', 'update_id', 'user_id', 'kind', 'callback', 'message', 'when_created', 'update'],
+    ),
+    'users': (
+        'user_id',
+        'when_authorized',
+        ['user_id', 'first_name', 'last_name', 'phone_number', 'when_authorized'],
+    ),
+}
+
+
+def connect(path):
+    """
+    Opens the database read-only: unlike Database(), nothing is migrated or vacuumed,
+    and a mistyped path fails instead of creating an empty database
+    """
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f'No database at {path}')
+    con = sqlite3.connect(f'file:{pathname2url(os.path.abspath(path))}?mode=ro', uri=True)
+    con.row_factory = sqlite3.Row
+    return con
+
+
+def iter_rows(db, table, since=None, until=None, user_id=None, after_id=0, batch_size=1000):
+    """Yields rows as dicts in id order, fetching batch_size rows at a time, db is a connection from connect()"""
+    id_column, date_column, columns = TABLES[table]
+    conditions = [f'{id_column} > ?']
+    args = [after_id]
+    if since is not None:
+        conditions.append(f'{date_column} >= ?')
+        args.append(since.strftime('%Y-%m-%d'))
+    if until is not None:
+        conditions.append(f'{date_column} < ?')
+        args.append(until.strftime('%Y-%m-%d'))
+    if user_id is not None:
+        conditions.append('user_id = ?')
+        args.append(user_id)
+
+    select = ', '.join(column for column in columns if column != 'update')
+    if table == 'activity_log':
+        select += ', payload, update_query'
+    cur = db.execute(f"SELECT {select} FROM {table} WHERE {' AND '.join(conditions)} ORDER BY {id_column}", args)
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            record = {column: row[column] for column in columns if column != 'update'}
+            if table == 'activity_log':
+                # Rows logged before payload was introduced keep str(update) in update_query
+                record['update'] = decode_payload(row['payload']) if row['payload'] else row['update_query']
+            yield record
+
+
+def write_csv(records, f, columns):
+    writer = csv.DictWriter(f, columns)
+    writer.writeheader()
+    for record in records:
+        if isinstance(record.get('update'), dict):
+            record['update'] = json.dumps(record['update'], ensure_ascii=False)
+        writer.writerow(record)
+        yield record
+
+
+def write_jsonl(records, f, columns):
+    for record in records:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        yield record
+
+
+def export(db, table, path, output_format='jsonl', after_id=0, **filters):
+    """Writes matching rows to a gzipped file, returns (number of rows, last exported id)"""
+    id_column, _, columns = TABLES[table]
+    write = write_csv if output_format == 'csv' else write_jsonl
+    count = 0
+    last_id = after_id
+    with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+        for record in write(iter_rows(db, table, after_id=after_id, **filters), f, columns):
+            count += 1
+            last_id = record[id_column]
+    return count, last_id
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_checkpoint(path, last_id):
+    with open(path + '.tmp', 'w') as f:
+        f.write(str(last_id))
+    os.replace(path + '.tmp', path)
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export activity_log or users to gzipped CSV or JSON lines')
+    parser.add_argument('table', choices=sorted(TABLES))
+    parser.add_argument('--database', default='database.db')
+    parser.add_argument('--format', choices=['csv', 'jsonl'], default='jsonl')
+    parser.add_argument('--output', help='defaults to <table>-<timestamp>.<format>.gz')
+    parser.add_argument('--since', type=parse_date, help='YYYY-MM-DD, inclusive (users: authorization date)')
+    parser.add_argument('--until', type=parse_date, help='YYYY-MM-DD, exclusive (users: authorization date)')
+    parser.add_argument('--user-id', type=int)
+    parser.add_argument('--after-id', type=int, default=0, help='export only rows with a greater id')
+    parser.add_argument('--checkpoint', metavar='FILE', help='resume after the id stored in FILE and update it')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    try:
+        db = connect(args.database)
+    except FileNotFoundError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    after_id = read_checkpoint(args.checkpoint) if args.checkpoint else args.after_id
+    output = args.output or f'{args.table}-{datetime.datetime.now():%Y%m%d-%H%M%S}.{args.format}.gz'
+    count, last_id = export(
+        db,
+        args.table,
+        output,
+        args.format,
+        after_id=after_id,
+        since=args.since,
+        until=args.until,
+        user_id=args.user_id,
+        batch_size=args.batch_size
+    )
+    if args.checkpoint:
+        write_checkpoint(args.checkpoint, last_id)
+    print(f'{count} rows exported to {output}, last id {last_id}')
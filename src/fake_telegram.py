@@ -0,0 +1,212 @@
+import argparse
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+
+sys.path.append("../")
+
+import requests
+
+from src.http_server import ThreadingHTTPServer
+from src.webhook import SECRET_TOKEN_HEADER
+
+'''
+Offline harness for load testing the bot:
+
+1. Fake Bot API, point the bot to it with `telegram_base_url = 'http://127.0.0.1:8081/bot'` in env.py:
+    python src/fake_telegram.py api --port 8081
+2. POST synthetic updates to the webhook listener:
+    python src/fake_telegram.py post --url http://127.0.0.1:8443/telegram --secret <webhook_secret_token> --updates 1000
+'''
+
+CALLBACKS = ['main', 'day_offs_menu', 'day_offs_mine', 'day_offs_paid', 'salary', 'currency', 'help']
+
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+
+
+def make_user(chat_id):
+    return {'id': chat_id, 'is_bot': False, 'first_name': f'User{chat_id}'}
+
+
+def make_message(chat_id, text=None, contact=None):
+    message = {
+        'message_id': next(message_ids),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': make_user(chat_id),
+    }
+    if text is not None:
+        message['text'] = text
+    if contact is not None:
+        message['contact'] = contact
+    return message
+
+
+def make_text_update(chat_id, text):
+    return {'update_id': next(update_ids), 'message': make_message(chat_id, text=text)}
+
+
+def make_contact_update(chat_id, phone_number):
+    contact = {'phone_number': phone_number, 'first_name': f'User{chat_id}', 'user_id': chat_id}
+    return {'update_id': next(update_ids), 'message': make_message(chat_id, contact=contact)}
+
+
+def make_callback_update(chat_id, data):
+    return {
+        'update_id': next(update_ids),
+        'callback_query': {
+            'id': str(next(update_ids)),
+            'from': make_user(chat_id),
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': make_message(chat_id, text='Choose an option:'),
+        },
+    }
+
+
+def make_random_update(chats):
+    chat_id = random.randint(1, chats)
+    if random.random() < 0.1:
+        return make_text_update(chat_id, '/start')
+    return make_callback_update(chat_id, random.choice(CALLBACKS))
+
+
+class FakeServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 drops connections under load, and every dropped SYN costs a 1s retransmit:
+    # latencies measured would be the harness', not the bot's
+    request_queue_size = 128
+
+
+class FakeTelegramApiHandler(BaseHTTPRequestHandler):
+    # Answers every /bot<token>/<method> call the way Bot API would, without side effects
+    protocol_version = 'HTTP/1.1'  # keep-alive: the bot's connection pool reuses connections
+    disable_nagle_algorithm = True  # headers and body are separate writes, Nagle would hold the body for 40ms
+
+    def do_POST(self):
+        api = self.server.api
+        method = self.path.rstrip('/').rsplit('/', 1)[-1]
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        try:
+            params = json.loads(body.decode('utf-8')) if body else {}
+        except ValueError:
+            params = {}  # multipart upload
+
+        if api.latency:
+            time.sleep(api.latency)
+        api.calls[method] += 1
+
+        body = json.dumps({'ok': True, 'result': api.result(method, params)}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTelegramApi:
+    def __init__(self, listen='127.0.0.1', port=0, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.__httpd = FakeServer((listen, port), FakeTelegramApiHandler)
+        self.__httpd.api = self
+
+    @property
+    def base_url(self):
+        host, port = self.__httpd.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def result(self, method, params):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+        if method in ('sendMessage', 'editMessageText', 'sendPhoto'):
+            message = make_message(int(params.get('chat_id') or 0), text=params.get('text'))
+            if method == 'sendPhoto':
+                message['photo'] = [{'file_id': 'fake-file-id', 'file_unique_id': 'fake', 'width': 1, 'height': 1}]
+            return message
+        if method == 'getUpdates':
+            return []
+        return True
+
+    def start(self):
+        threading.Thread(target=self.__httpd.serve_forever, name='fake-telegram-api', daemon=True).start()
+
+    def stop(self):
+        self.__httpd.shutdown()
+        self.__httpd.server_close()
+
+
+def post_updates(url, secret_token, updates, concurrency=8):
+    """POSTs updates to the webhook listener, returns {'statuses', 'latencies', 'duration'}"""
+    session = requests.Session()
+    statuses = Counter()
+    latencies = []
+    lock = threading.Lock()
+
+    def post(update):
+        started = time.monotonic()
+        status = session.post(url, json=update, headers={SECRET_TOKEN_HEADER: secret_token}, timeout=30).status_code
+        with lock:
+            statuses[status] += 1
+            latencies.append(time.monotonic() - started)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(post, updates))
+    return {'statuses': statuses, 'latencies': latencies, 'duration': time.monotonic() - started}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Telegram for offline load tests')
+    subparsers = parser.add_subparsers(dest='command')
+    api_parser = subparsers.add_parser('api', help='serve a fake Bot API')
+    api_parser.add_argument('--port', type=int, default=8081)
+    api_parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every call')
+    post_parser = subparsers.add_parser('post', help='POST synthetic updates to the webhook listener')
+    post_parser.add_argument('--url', default='http://127.0.0.1:8443/telegram')
+    post_parser.add_argument('--secret', default='')
+    post_parser.add_argument('--updates', type=int, default=1000)
+    post_parser.add_argument('--chats', type=int, default=100)
+    post_parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    if args.command == 'api':
+        api = FakeTelegramApi(port=args.port, latency=args.latency)
+        print(f'Fake Bot API listening on {api.base_url}')
+        try:
+            api.start()
+            while True:
+                time.sleep(10)
+                print(dict(api.calls))
+        except KeyboardInterrupt:
+            api.stop()
+    elif args.command == 'post':
+        result = post_updates(
+            args.url,
+            args.secret,
+            [make_random_update(args.chats) for _ in range(args.updates)],
+            args.concurrency
+        )
+        print(f"{args.updates} updates in {result['duration']:.2f}s ({args.updates / result['duration']:.0f}/s)")
+        print(f"statuses: {dict(result['statuses'])}")
+        for p in (50, 95, 99):
+            print(f"p{p}: {percentile(result['latencies'], p) * 1000:.1f}ms")
+    else:
+        parser.print_help()
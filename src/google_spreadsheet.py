@@ -1,6 +1,106 @@
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+import config as config_global
 import env
+from src.metrics import track_upstream
+from src.resilience import ResilientCall
+from src.single_flight import SingleFlight
+from src.utils import normalize_phone_number
+
+logger = logging.getLogger(__name__)
+
+
+def read_json(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logger.warning(f'Ignoring corrupted {path}')
+        return None
+
+
+def write_json(path, data, mode=0o600):
+    # Written to a temporary file and renamed, so a crash never leaves half a file
+    tmp_path = path + '.tmp'
+    with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class EmployeeRecord:
+    """A row of the sheet: only the columns the bot reads, normalized once when the sheet is loaded"""
+
+    # sheet column -> attribute
+    COLUMNS = {
+        'Name': 'name',
+        'Phone number': 'phone_number',
+        'Salary': 'salary',
+        'Day-offs': 'day_offs',
+    }
+    __slots__ = tuple(COLUMNS.values())
+
+    def __init__(self, name='', phone_number='', salary='', day_offs=''):
+        self.name = ' '.join(str(name).split())
+        self.phone_number = normalize_phone_number(phone_number)
+        self.salary = str(salary)
+        self.day_offs = str(day_offs)
+
+    @classmethod
+    def from_dict(cls, record):
+        return cls(**{attribute: record.get(column, '') for column, attribute in cls.COLUMNS.items()})
+
+    def to_dict(self):
+        return {column: getattr(self, attribute) for column, attribute in self.COLUMNS.items()}
+
+    def get(self, column, default=None):
+        # Same lookup as on the dicts returned by get_all_records()
+        attribute = self.COLUMNS.get(column)
+        return default if attribute is None else getattr(self, attribute)
+
+    def __getitem__(self, column):
+        return getattr(self, self.COLUMNS[column])
+
+    def __repr__(self):
+        return f'EmployeeRecord({self.to_dict()!r})'
+
+
+class SpreadsheetSnapshot:
+    """In-memory copy of the sheet with hash indexes on the lookup columns"""
+
+    def __init__(self, records, index_keys, age=0):
+        self.records = records
+        self.when_loaded = time.monotonic() - age
+        self.__indexes = {}
+        for key in index_keys:
+            index = {}
+            for record in records:
+                value = record.get(key)
+                if value:
+                    index.setdefault(value, record)  # first row wins, same as a linear scan
+            self.__indexes[key] = index
+
+    @staticmethod
+    def normalize(key, value):
+        if key == 'Phone number':
+            return normalize_phone_number(value)
+        return ' '.join(str(value).split())
+
+    def find(self, key, value):
+        if key in self.__indexes:
+            return self.__indexes[key].get(self.normalize(key, value))
+
+        value = self.normalize(key, value)
+        for record in self.records:
+            if self.normalize(key, record.get(key, '')) == value:
+                return record
+        return None
 
 
 # instructions: https://www.twilio.com/blog/2017/02/an-easy-way-to-read-and-write-to-a-google-spreadsheet-in-python.html
@@ -13,44 +113,182 @@ class GoogleSpreadsheetReader:
     ]
     SHEET_URL = env.google_spreadsheet_url
 
-    def __init__(self):
+    def __init__(self, ttl=None):
         self._gc = None
         self._credentials = None
+        self._ttl = config_global.spreadsheet['ttl'] if ttl is None else ttl
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._revalidating = threading.Lock()
+        self._listeners = []
+        self._flight = SingleFlight('spreadsheet')
+        # On failure the previous snapshot stays in use, so an outage only delays updates of the sheet
+        self._upstream = ResilientCall('spreadsheet', **config_global.resilience['spreadsheet'])
+        self._snapshot_path = config_global.spreadsheet['snapshot_path']
+        self._token_path = config_global.spreadsheet['token_path']
 
     @property
     def credentials(self):
         if self._credentials is None:
+            # gspread and oauth2client are imported on first use, they are slow to import at startup
+            from oauth2client.service_account import ServiceAccountCredentials
+
             creds = ServiceAccountCredentials.from_json_keyfile_dict(
                 env.google_spreadsheet_keyfile_dict,
                 self.SCOPES
             )
+            # The access token of the previous run is reused while it's valid: no authorization round trip on boot
+            token = read_json(self._token_path)
+            if token is not None:
+                creds.access_token = token['access_token']
+                creds.token_expiry = datetime.datetime.strptime(token['token_expiry'], '%Y-%m-%dT%H:%M:%S')
             self._credentials = creds
         return self._credentials
 
     @property
     def gc(self):
         if self._gc is None:
+            import gspread
+
             self._gc = gspread.authorize(self.credentials)
+            self.__save_token()
         return self._gc
 
     @property
     def sheet(self):
         if self.credentials.access_token_expired:
             self.gc.login()
+            self.__save_token()
         return self.gc.open_by_url(self.SHEET_URL).sheet1
 
+    def __save_token(self):
+        creds = self.credentials
+        if creds.access_token and creds.token_expiry:
+            try:
+                write_json(self._token_path, {
+                    'access_token': creds.access_token,
+                    'token_expiry': creds.token_expiry.strftime('%Y-%m-%dT%H:%M:%S'),
+                })
+            except OSError:
+                logger.exception('Could not save the access token')
+
+    @property
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                loaded = self._snapshot is not None or self.load_saved()
+            return self._snapshot if loaded else self.refresh()
+
+        # stale-while-revalidate: answer from the old copy, refresh in the background
+        if time.monotonic() - snapshot.when_loaded > self._ttl:
+            self.__revalidate()
+        return snapshot
+
+    def load_saved(self):
+        """Serves the snapshot saved by the previous run until the sheet is downloaded again, returns False if none"""
+        saved = read_json(self._snapshot_path)
+        if saved is None:
+            return False
+        # Its age counts from when it was saved, so an old copy is revalidated on first use
+        age = max(0, time.time() - saved['when_saved'])
+        records = [EmployeeRecord.from_dict(record) for record in saved['records']]
+        self._snapshot = SpreadsheetSnapshot(records, config_global.spreadsheet['index_keys'], age=age)
+        return True
+
+    def add_refresh_listener(self, listener):
+        """listener(snapshot) is called after every successful refresh"""
+        self._listeners.append(listener)
+
+    def refresh(self):
+        """Downloads the sheet, concurrent calls (refresher, revalidation, first use) share one download"""
+        return self._flight.do('sheet', self.__refresh)
+
+    def __refresh(self):
+        with self._lock:
+            self.__load()
+        return self._snapshot
+
+    def start_refresher(self):
+        thread = threading.Thread(target=self.__refresh_loop, name='spreadsheet-refresher', daemon=True)
+        thread.start()
+        return thread
+
+    def __refresh_loop(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Spreadsheet refresh failed, keeping the previous snapshot')
+            time.sleep(self._ttl)
+
+    def __revalidate(self):
+        if not self._revalidating.acquire(blocking=False):
+            return
+
+        def revalidate():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Spreadsheet revalidation failed, keeping the previous snapshot')
+            finally:
+                self._revalidating.release()
+
+        threading.Thread(target=revalidate, name='spreadsheet-revalidate', daemon=True).start()
+
+    def fetch_records(self):
+        """Downloads only the EmployeeRecord columns: the header row, then all columns in one batched request"""
+        from gspread.utils import numericise, rowcol_to_a1
+
+        worksheet = self.sheet
+        with track_upstream('gspread', 'row_values'):
+            header = worksheet.row_values(1)
+        columns = [column for column in EmployeeRecord.COLUMNS if column in header]
+        missing = set(EmployeeRecord.COLUMNS) - set(columns)
+        if missing:
+            logger.warning(f"Spreadsheet has no columns {', '.join(sorted(missing))}")
+
+        title = worksheet.title.replace("'", "''")
+        ranges = []
+        for column in columns:
+            letter = rowcol_to_a1(1, header.index(column) + 1)[:-1]
+            ranges.append(f"'{title}'!{letter}2:{letter}")
+        with track_upstream('gspread', 'values_batch_get'):
+            response = worksheet.spreadsheet.values_batch_get(ranges, params={'majorDimension': 'COLUMNS'})
+
+        # Every range is one column, trailing empty cells are omitted
+        values = [(value_range.get('values') or [[]])[0] for value_range in response.get('valueRanges', [])]
+        attributes = [EmployeeRecord.COLUMNS[column] for column in columns]
+        records = []
+        for i in range(max(map(len, values), default=0)):
+            # numericise() as in get_all_records(), so values and row hashes stay the same
+            records.append(EmployeeRecord(**{
+                attribute: numericise(column_values[i]) if i < len(column_values) else ''
+                for attribute, column_values in zip(attributes, values)
+            }))
+        return records
+
+    def __load(self):
+        records = self._upstream(self.fetch_records)
+        self._snapshot = SpreadsheetSnapshot(records, config_global.spreadsheet['index_keys'])
+        try:
+            write_json(
+                self._snapshot_path,
+                {'when_saved': time.time(), 'records': [record.to_dict() for record in records]}
+            )
+        except OSError:
+            logger.exception('Could not save the spreadsheet snapshot')
+        for listener in self._listeners:
+            try:
+                listener(self._snapshot)
+            except Exception:
+                logger.exception('Spreadsheet refresh listener failed')
+
     def get_all_records(self):
-        return self.sheet.get_all_records()
+        return self.snapshot.records
 
     def get_record_by_condition(self, key, value):
-        records = self.get_all_records()
-        for record in records:
-            if key in record:
-                if str(record[key]) == str(value):
-                    return record
-            else:
-                return None
-        return None
+        return self.snapshot.find(key, value)
 
     def get_all_values(self):
         return self.sheet.get_all_values()
@@ -0,0 +1,7 @@
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is only available since Python 3.7
+    daemon_threads = True
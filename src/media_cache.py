@@ -0,0 +1,69 @@
+import hashlib
+import os
+import threading
+
+from telegram.error import BadRequest
+
+
+class MediaCache:
+    """
+    Remembers file_id Telegram returns for uploaded files, so every file is uploaded once.
+    Files are keyed by content hash: a replaced file is uploaded again.
+    """
+
+    def __init__(self, db):
+        self.__db = db
+        self.__keys = {}  # path -> (mtime, size, content hash)
+        self.__file_ids = {}  # content hash -> file_id
+        self.__lock = threading.Lock()
+
+    def get_key(self, path):
+        # The file is hashed again only when its mtime or size changed, i.e. it was replaced
+        stat = os.stat(path)
+        with self.__lock:
+            cached = self.__keys.get(path)
+            if cached is None or cached[:2] != (stat.st_mtime_ns, stat.st_size):
+                with open(path, 'rb') as f:
+                    cached = (stat.st_mtime_ns, stat.st_size, hashlib.sha1(f.read()).hexdigest())
+                self.__keys[path] = cached
+            return cached[2]
+
+    def get(self, path):
+        key = self.get_key(path)
+        if key not in self.__file_ids:
+            row = self.__db.execute('SELECT media_cache.file_id FROM media_cache WHERE media_cache.key = ?', key).fetchone()
+            if row is None:
+                return None
+            self.__file_ids[key] = row['file_id']
+        return self.__file_ids[key]
+
+    def put(self, path, file_id):
+        key = self.get_key(path)
+        self.__file_ids[key] = file_id
+        self.__db.execute(
+            """
+                INSERT OR REPLACE INTO media_cache(key, path, file_id, when_created)
+                VALUES(?, ?, ?, datetime('now'))
+            """,
+            key,
+            path,
+            file_id
+        )
+
+    def forget(self, path):
+        key = self.get_key(path)
+        self.__file_ids.pop(key, None)
+        self.__db.execute('DELETE FROM media_cache WHERE media_cache.key = ?', key)
+
+    def send_photo(self, bot, path, **kwargs):
+        file_id = self.get(path)
+        if file_id is not None:
+            try:
+                return bot.send_photo(photo=file_id, **kwargs)
+            except BadRequest:  # file_id is no longer valid, e.g. bot token has changed
+                self.forget(path)
+
+        with open(path, 'rb') as photo:
+            message = bot.send_photo(photo=photo, **kwargs)
+        self.put(path, message.photo[-1].file_id)
+        return message
@@ -0,0 +1,90 @@
+import logging
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from src.screens import build_menu
+
+logger = logging.getLogger(__name__)
+
+# Bumped when the meaning of callback data changes, buttons of older versions are still routed by name
+CALLBACK_VERSION = 1
+CALLBACK_SEPARATOR = ':'
+
+
+def encode_callback(name, *params, version=CALLBACK_VERSION):
+    """'v1:name:param:...', Telegram allows up to 64 bytes of callback data"""
+    data = CALLBACK_SEPARATOR.join([f'v{version}', name] + [str(param) for param in params])
+    if len(data.encode('utf-8')) > 64:
+        raise ValueError(f'Callback data is longer than 64 bytes: {data}')
+    return data
+
+
+def parse_callback(data):
+    """Returns (version, name, params). Buttons sent before versioning carry just the name: version 0"""
+    parts = (data or '').split(CALLBACK_SEPARATOR)
+    if len(parts) > 1 and parts[0][:1] == 'v' and parts[0][1:].isdigit():
+        return int(parts[0][1:]), parts[1], parts[2:]
+    return 0, parts[0], parts[1:]
+
+
+class MenuNode:
+    """
+    A menu screen or button. `title` and `url` may be callables, they are read every time keyboards are built.
+    The node's keyboard is `buttons` in `n_cols` columns, with `header` and `footer` rows, all given by node name.
+    `params` names the values its callback data carries, the handler gets them as keywords: handler(bot, update, **params)
+    """
+
+    def __init__(self, name, title, handler=None, buttons=(), header=(), footer=(), n_cols=2, url=None, params=()):
+        self.name = name
+        self.title = title
+        self.handler = handler
+        self.params = tuple(params)
+        self.buttons = list(buttons)
+        self.header = list(header)
+        self.footer = list(footer)
+        self.n_cols = n_cols
+        self.url = url
+
+    @property
+    def has_keyboard(self):
+        return bool(self.buttons or self.header or self.footer)
+
+
+class Menu:
+    """Menu tree: keyboards are built from it, and callback queries are routed by one dict lookup"""
+
+    def __init__(self, nodes):
+        self.nodes = {node.name: node for node in nodes}
+        for node in nodes:
+            for child in node.header + node.buttons + node.footer:
+                if child not in self.nodes:
+                    raise ValueError(f'Menu node {node.name} refers to unknown node {child}')
+
+    def button(self, name, *params):
+        node = self.nodes[name]
+        if len(params) != len(node.params):
+            raise ValueError(f'Menu node {name} takes parameters {node.params}, got {params}')
+        title = node.title() if callable(node.title) else node.title
+        if node.url is not None:
+            return InlineKeyboardButton(title, url=node.url() if callable(node.url) else node.url)
+        return InlineKeyboardButton(title, callback_data=encode_callback(name, *params))
+
+    def keyboard(self, name):
+        node = self.nodes[name]
+        return InlineKeyboardMarkup(build_menu(
+            buttons=[self.button(child) for child in node.buttons],
+            n_cols=node.n_cols,
+            header_buttons=[self.button(child) for child in node.header],
+            footer_buttons=[self.button(child) for child in node.footer]
+        ))
+
+    def dispatch(self, bot, update):
+        query = update.callback_query
+        version, name, params = parse_callback(query.data)
+        node = self.nodes.get(name)
+        # Buttons of an older version may carry other parameters than the node takes now
+        if node is None or node.handler is None or len(params) != len(node.params):
+            logger.warning(f'No handler for callback data {query.data!r} (version {version})')
+            bot.answer_callback_query(callback_query_id=query.id, text='This button is no longer available')
+            return
+        return node.handler(bot, update, **dict(zip(node.params, params)))
@@ -0,0 +1,180 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+
+from src.http_server import ThreadingHTTPServer
+from src.profiler import add_phase
+
+# Prometheus text exposition: https://prometheus.io/docs/instrumenting/exposition_formats/
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def sort_key(item):
+    # label values may mix types, e.g. handler groups -1 and 'menu'
+    return tuple(str(label) for label in item[0])
+
+
+def format_labels(labelnames, labels):
+    if not labelnames:
+        return ''
+    pairs = []
+    for name, value in zip(labelnames, labels):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.__values = {}
+        self.__lock = threading.Lock()
+
+    def inc(self, *labels, value=1):
+        with self.__lock:
+            self.__values[labels] = self.__values.get(labels, 0) + value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.__lock:
+            values = dict(self.__values)
+        for labels, value in sorted(values.items(), key=sort_key):
+            lines.append(f'{self.name}{format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.__values = {}  # labels -> [counts per bucket..., +Inf count, sum]
+        self.__lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            values = self.__values.get(labels)
+            if values is None:
+                values = self.__values[labels] = [0] * (len(self.buckets) + 2)
+            values[index] += 1
+            values[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.__lock:
+            values = {labels: list(counts) for labels, counts in self.__values.items()}
+        labelnames = self.labelnames + ('le',)
+        for labels, counts in sorted(values.items(), key=sort_key):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{format_labels(labelnames, labels + (bound,))} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {counts[-1]}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+
+class Gauge:
+    """Value is read when metrics are scraped: callback() returns {labels tuple: value}"""
+
+    def __init__(self, name, help, labelnames, callback):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.callback = callback
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        for labels, value in sorted(self.callback().items(), key=sort_key):
+            lines.append(f'{self.name}{format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.__metrics = {}
+        self.__lock = threading.Lock()
+
+    def register(self, metric):
+        with self.__lock:
+            # Registering the same name again returns the existing metric, e.g. for a second Bot in benchmarks
+            return self.__metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, labelnames, callback):
+        gauge = Gauge(name, help, labelnames, callback)
+        with self.__lock:
+            self.__metrics[name] = gauge  # the latest callback wins
+        return gauge
+
+    def render(self):
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+handler_seconds = registry.histogram('bot_handler_seconds', 'Handler latency', ('group', 'handler'))
+handler_errors = registry.counter('bot_handler_errors_total', 'Handler errors by exception class', ('group', 'handler', 'error'))
+upstream_seconds = registry.histogram('bot_upstream_seconds', 'Outbound dependency call latency', ('dependency', 'call'))
+upstream_errors = registry.counter('bot_upstream_errors_total', 'Outbound dependency call errors', ('dependency', 'call', 'error'))
+
+
+@contextmanager
+def track_upstream(dependency, call):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        upstream_errors.inc(dependency, call, type(e).__name__)
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        upstream_seconds.observe(seconds, dependency, call)
+        add_phase(f'{dependency} {call}', seconds)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(listen='127.0.0.1', port=9090):
+    httpd = ThreadingHTTPServer((listen, port), MetricsRequestHandler)
+    threading.Thread(target=httpd.serve_forever, name='metrics', daemon=True).start()
+    return httpd
@@ -0,0 +1,113 @@
+# Schema migrations, applied in order by Database.migrate().
+# The index of the last applied script is stored in `PRAGMA user_version`.
+# Never edit a released migration: append a new one instead.
+
+MIGRATIONS = [
+    # 1: initial schema (IF NOT EXISTS, since databases created before migrations already have it)
+    """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY UNIQUE NOT NULL,
+            first_name VARCHAR(40) NOT NULL,
+            last_name VARCHAR(40) NOT NULL,
+            phone_number VARCHAR(40) NOT NULL,
+            when_authorized DATETIME
+        );
+
+        CREATE TABLE IF NOT EXISTS activity_log (
+            id INTEGER PRIMARY KEY ASC AUTOINCREMENT UNIQUE NOT NULL,
+            user_id INTEGER NOT NULL DEFAULT 0,
+            callback VARCHAR(40),
+            message TEXT,
+            update_query TEXT,
+            when_created DATETIME NOT NULL
+        );
+    """,
+
+    # 2: local mirror of the Google spreadsheet, see src/employees.py
+    """
+        CREATE TABLE IF NOT EXISTS employees (
+            phone_number VARCHAR(40) PRIMARY KEY UNIQUE NOT NULL,
+            name VARCHAR(80) NOT NULL,
+            salary TEXT,
+            day_offs TEXT,
+            row_hash CHAR(40) NOT NULL,
+            when_synced DATETIME NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS employees_name ON employees(name);
+
+        CREATE TABLE IF NOT EXISTS employees_sync_log (
+            id INTEGER PRIMARY KEY ASC AUTOINCREMENT UNIQUE NOT NULL,
+            when_started DATETIME NOT NULL,
+            duration_ms INTEGER NOT NULL,
+            rows_total INTEGER NOT NULL,
+            rows_inserted INTEGER NOT NULL,
+            rows_updated INTEGER NOT NULL,
+            rows_deleted INTEGER NOT NULL
+        );
+    """,
+
+    # 3: official exchange rates, see src/exchange_rates.py
+    """
+        CREATE TABLE IF NOT EXISTS exchange_rates (
+            date DATE NOT NULL,
+            currency_id INTEGER NOT NULL,
+            char_code VARCHAR(3),
+            nominal INTEGER NOT NULL DEFAULT 1,
+            value TEXT NOT NULL,
+            PRIMARY KEY (date, currency_id)
+        );
+    """,
+
+    # 4: indexed user lookups, phone numbers are stored digits-only (see src.utils.normalize_phone_number)
+    """
+        UPDATE users
+        SET phone_number = replace(replace(replace(replace(replace(phone_number, '+', ''), ' ', ''), '-', ''), '(', ''), ')', '');
+
+        CREATE INDEX users_phone_number ON users(phone_number);
+        CREATE INDEX users_full_name ON users(first_name, last_name);
+        CREATE INDEX users_when_authorized ON users(when_authorized);
+    """,
+
+    # 5: file_id of files uploaded to Telegram, see src/media_cache.py
+    """
+        CREATE TABLE media_cache (
+            key CHAR(40) PRIMARY KEY NOT NULL,
+            path TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            when_created DATETIME NOT NULL
+        );
+    """,
+
+    # 6: compact activity log, the update is stored as zlib-compressed JSON (see src/activity_log.py);
+    # update_query is kept for rows logged before
+    """
+        ALTER TABLE activity_log ADD COLUMN update_id INTEGER;
+        ALTER TABLE activity_log ADD COLUMN kind VARCHAR(10);
+        ALTER TABLE activity_log ADD COLUMN payload BLOB;
+
+        CREATE INDEX activity_log_when_created ON activity_log(when_created);
+    """,
+
+    # 7: usage rollups of activity_log, maintained by src/usage_stats.py up to rollup_checkpoints.last_id
+    """
+        CREATE TABLE usage_hourly (
+            hour DATETIME NOT NULL,
+            callback VARCHAR(40) NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (hour, callback)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE usage_daily (
+            day DATE NOT NULL,
+            callback VARCHAR(40) NOT NULL,
+            user_id INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (day, callback, user_id)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE rollup_checkpoints (
+            name VARCHAR(40) PRIMARY KEY NOT NULL,
+            last_id INTEGER NOT NULL
+        );
+    """,
+]
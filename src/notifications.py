@@ -0,0 +1,50 @@
+import logging
+
+from src.metrics import registry
+from src.outbound import OutboundQueue
+
+logger = logging.getLogger(__name__)
+
+change_notifications = registry.counter(
+    'bot_change_notifications_total',
+    'Users told that their salary or day-offs changed in the spreadsheet',
+    ('field',)
+)
+
+
+class ChangeNotifier:
+    """
+    Pushes salary and day-off changes found by EmployeeRepository.sync() to the authorized users they concern,
+    so they don't have to keep tapping the buttons to find out.
+    """
+
+    def __init__(self, users, outbound):
+        self.__users = users
+        self.__outbound = outbound
+
+    @staticmethod
+    def get_text(fields):
+        lines = []
+        if 'salary' in fields:
+            lines.append(f"Your salary has been updated: {fields['salary']}")
+        if 'day_offs' in fields:
+            lines.append(f"You have {fields['day_offs']} day-offs left")
+        return '\n'.join(lines)
+
+    def notify(self, bot, changes):
+        """Queues a message for every authorized user whose row changed, returns how many were queued"""
+        fields_by_phone_number = {change['phone_number']: change['fields'] for change in changes}
+        user_ids = self.__users.get_authorized_by_phone_numbers(list(fields_by_phone_number))
+        for phone_number, user_id in user_ids.items():
+            fields = fields_by_phone_number[phone_number]
+            # The broadcast lane: answers to users tapping buttons go first
+            self.__outbound.send(
+                bot.send_message,
+                priority=OutboundQueue.BROADCAST,
+                chat_id=user_id,
+                text=self.get_text(fields)
+            )
+            for field in fields:
+                change_notifications.inc(field)
+        logger.info(f'{len(changes)} employees changed, {len(user_ids)} authorized users notified')
+        return len(user_ids)
@@ -0,0 +1,194 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.__clock = clock
+        self.__updated = clock()
+
+    def refill(self):
+        now = self.__clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+    def take(self):
+        """Takes a token and returns 0, or returns how many seconds to wait for one"""
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    @property
+    def is_full(self):
+        self.refill()
+        return self.tokens >= self.capacity
+
+
+class OutboundQueue:
+    """
+    Sends Telegram API calls within flood limits: a global token bucket plus one per chat.
+    Interactive replies always go ahead of broadcasts, 429 responses are retried after `retry_after`.
+    """
+
+    INTERACTIVE = 0
+    BROADCAST = 1
+
+    def __init__(self, global_rate=30, per_chat_rate=1, per_chat_burst=3, broadcast_queue_size=1000, max_retries=3):
+        self.__global = TokenBucket(global_rate, global_rate)
+        self.__per_chat_rate = per_chat_rate
+        self.__per_chat_burst = per_chat_burst
+        self.__chats = {}  # chat_id -> TokenBucket
+        self.__broadcast_queue_size = broadcast_queue_size
+        self.__max_retries = max_retries
+        # Every lane keeps messages per chat in order, and a heap of (when_ready, seq, chat_id) of chats waiting to send
+        self.__lanes = {self.INTERACTIVE: {}, self.BROADCAST: {}}
+        self.__ready = {self.INTERACTIVE: [], self.BROADCAST: []}
+        self.__sizes = {self.INTERACTIVE: 0, self.BROADCAST: 0}
+        self.__seq = itertools.count()
+        self.__condition = threading.Condition()
+        self.__paused_until = 0
+        self.__running = False
+        self.__thread = None
+        self.__started_at = None
+        self.__sent_times = deque(maxlen=10000)
+        self.__counters = {'sent': 0, 'failed': 0, 'retried': 0}
+
+    def start(self):
+        self.__running = True
+        self.__started_at = time.monotonic()
+        self.__thread = threading.Thread(target=self.__run, name='outbound', daemon=True)
+        self.__thread.start()
+
+    def stop(self, timeout=10):
+        """Sends what's queued for up to `timeout` seconds, then stops"""
+        deadline = time.monotonic() + timeout
+        with self.__condition:
+            while any(self.__sizes.values()) and time.monotonic() < deadline:
+                self.__condition.wait(0.1)
+            self.__running = False
+            self.__condition.notify_all()
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+
+    def send(self, method, priority=INTERACTIVE, **kwargs):
+        """Queues method(**kwargs) for kwargs['chat_id'], e.g. send(bot.send_message, chat_id=chat_id, text='Hi')"""
+        with self.__condition:
+            if priority == self.BROADCAST:
+                while self.__running and self.__sizes[self.BROADCAST] >= self.__broadcast_queue_size:
+                    self.__condition.wait()
+            self.__push(priority, {'chat_id': kwargs['chat_id'], 'method': method, 'kwargs': kwargs, 'attempt': 0})
+
+    def broadcast(self, bot, chat_ids, text, **kwargs):
+        """Queues text for every chat id, chat_ids may be a generator: it's consumed as the queue drains"""
+        count = 0
+        for chat_id in chat_ids:
+            self.send(bot.send_message, priority=self.BROADCAST, chat_id=chat_id, text=text, **kwargs)
+            count += 1
+        return count
+
+    def stats(self):
+        with self.__condition:
+            now = time.monotonic()
+            stats = dict(self.__counters)
+            stats['queue_interactive'] = self.__sizes[self.INTERACTIVE]
+            stats['queue_broadcast'] = self.__sizes[self.BROADCAST]
+            # Over the last minute, or since start during the first one
+            window = 60 if self.__started_at is None else max(1, min(60, now - self.__started_at))
+            stats['per_second'] = sum(1 for sent in self.__sent_times if sent > now - window) / window
+        return stats
+
+    def __push(self, priority, message, first=False, when_ready=None):
+        chat_id = message['chat_id']
+        messages = self.__lanes[priority].get(chat_id)
+        if messages is None:
+            messages = self.__lanes[priority][chat_id] = deque()
+            heapq.heappush(self.__ready[priority], (when_ready or time.monotonic(), next(self.__seq), chat_id))
+        if first:
+            messages.appendleft(message)
+        else:
+            messages.append(message)
+        self.__sizes[priority] += 1
+        self.__condition.notify_all()
+
+    def __next(self):
+        # Returns (priority, message) of the next message that can be sent now, or seconds to wait
+        now = time.monotonic()
+        if now < self.__paused_until:
+            return self.__paused_until - now
+
+        wait = None
+        for priority in (self.INTERACTIVE, self.BROADCAST):
+            ready = self.__ready[priority]
+            while ready and ready[0][0] <= now:
+                when_ready, seq, chat_id = heapq.heappop(ready)
+                chat = self.__chats.get(chat_id)
+                if chat is None:
+                    chat = self.__chats[chat_id] = TokenBucket(self.__per_chat_rate, self.__per_chat_burst)
+                chat_wait = chat.take()
+                if chat_wait:
+                    heapq.heappush(ready, (now + chat_wait, seq, chat_id))
+                    continue
+                global_wait = self.__global.take()
+                if global_wait:
+                    chat.tokens += 1  # give back, the chat will be tried again
+                    heapq.heappush(ready, (when_ready, seq, chat_id))
+                    return global_wait
+
+                messages = self.__lanes[priority][chat_id]
+                message = messages.popleft()
+                self.__sizes[priority] -= 1
+                if messages:
+                    heapq.heappush(ready, (now, next(self.__seq), chat_id))  # behind chats already waiting
+                else:
+                    del self.__lanes[priority][chat_id]
+                return priority, message
+            if ready:
+                wait = ready[0][0] - now if wait is None else min(wait, ready[0][0] - now)
+        return wait
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while True:
+                    if not self.__running:
+                        return
+                    next_message = self.__next()
+                    if isinstance(next_message, tuple):
+                        break
+                    self.__condition.wait(next_message)
+                self.__condition.notify_all()  # room in the broadcast lane
+                if len(self.__chats) > 10000:
+                    self.__chats = {chat_id: chat for chat_id, chat in self.__chats.items() if not chat.is_full}
+
+            priority, message = next_message
+            try:
+                message['method'](**message['kwargs'])
+                with self.__condition:
+                    self.__counters['sent'] += 1
+                    self.__sent_times.append(time.monotonic())
+            except RetryAfter as e:
+                with self.__condition:
+                    self.__paused_until = time.monotonic() + e.retry_after
+                    if message['attempt'] < self.__max_retries:
+                        message['attempt'] += 1
+                        self.__counters['retried'] += 1
+                        self.__push(priority, message, first=True, when_ready=self.__paused_until)
+                    else:
+                        self.__counters['failed'] += 1
+            except Exception:
+                logger.exception(f"Could not send message to chat {message['chat_id']}")
+                with self.__condition:
+                    self.__counters['failed'] += 1
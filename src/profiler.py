@@ -0,0 +1,136 @@
+import datetime
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+from src.activity_log import get_update_kind
+
+'''
+Production diagnostics without redeploying:
+
+    SamplingProfiler: samples the stacks of every thread with sys._current_frames(), no tracing hooks,
+    so handlers run at full speed while it's on. Output is in collapsed-stack format, one line per stack:
+    "thread;outer (file:line);...;inner (file:line) samples", ready for flamegraph.pl or speedscope.
+
+    SlowUpdateRecorder: times every update through all handler groups and keeps the slow ones,
+    with time spent per phase (handlers, SQLite, Telegram, Google Sheets, bnm.md), in a ring buffer.
+'''
+
+_local = threading.local()
+
+
+def add_phase(name, seconds):
+    """Adds time to the update being processed by this thread, if it's being recorded"""
+    phases = getattr(_local, 'phases', None)
+    if phases is not None:
+        phases[name] = phases.get(name, 0) + seconds
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def frame_name(frame):
+        code = frame.f_code
+        return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+    def profile(self, seconds):
+        """Samples every thread for `seconds`, returns (number of samples, Counter of collapsed stacks)"""
+        if not self.__lock.acquire(blocking=False):
+            raise RuntimeError('A profile is already running')
+        try:
+            own_ident = threading.get_ident()
+            stacks = Counter()
+            samples = 0
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_ident:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(self.frame_name(frame))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    stacks[';'.join(reversed(stack))] += 1
+                samples += 1
+                time.sleep(self.interval)
+            return samples, stacks
+        finally:
+            self.__lock.release()
+
+    @staticmethod
+    def format_collapsed(stacks):
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+    @staticmethod
+    def top_functions(stacks, limit=5, skip_threads=()):
+        """Functions seen most often on top of a stack (self time), except in threads named in skip_threads"""
+        functions = Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(';')
+            if frames[0] not in skip_threads and len(frames) > 1:
+                functions[frames[-1]] += count
+        return functions.most_common(limit)
+
+
+class SlowUpdateRecorder:
+    """Ring buffer of the last `size` updates that took longer than `threshold_ms` in the dispatcher"""
+
+    def __init__(self, threshold_ms=500, size=200):
+        self.threshold = threshold_ms / 1000
+        self.__updates = deque(maxlen=size)
+        self.__lock = threading.Lock()
+        self.__counters = {'processed': 0, 'slow': 0}
+
+    def wrap(self, process_update):
+        """Wraps Dispatcher.process_update, which runs the handlers of every group for one update"""
+        def recorded(update):
+            _local.phases = {}
+            started = time.perf_counter()
+            try:
+                return process_update(update)
+            finally:
+                seconds = time.perf_counter() - started
+                phases = _local.phases
+                _local.phases = None
+                self.record(update, seconds, phases)
+
+        return recorded
+
+    def record(self, update, seconds, phases):
+        slow = seconds >= self.threshold
+        with self.__lock:
+            self.__counters['processed'] += 1
+            if not slow:
+                return
+            self.__counters['slow'] += 1
+
+        chat = getattr(update, 'effective_chat', None)
+        entry = {
+            'when': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'update_id': getattr(update, 'update_id', None),
+            'chat_id': chat.id if chat is not None else None,
+            'kind': get_update_kind(update) if hasattr(update, 'update_id') else type(update).__name__,
+            'ms': round(seconds * 1000, 1),
+            # Phases overlap: a handler's time includes the SQLite and API calls it made
+            'phases': sorted(((name, round(value * 1000, 1)) for name, value in phases.items()), key=lambda item: -item[1]),
+        }
+        with self.__lock:
+            self.__updates.append(entry)
+
+    def recent(self, limit=10):
+        """Recorded updates, newest first"""
+        with self.__lock:
+            return list(reversed(self.__updates))[:limit]
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__counters)
+            stats['kept'] = len(self.__updates)
+        return stats
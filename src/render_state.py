@@ -0,0 +1,50 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+def render_hash(text, reply_markup=None, parse_mode=None):
+    markup = reply_markup.to_dict() if reply_markup is not None else None
+    content = json.dumps([text, markup, parse_mode], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class RenderStateStore:
+    """Hash of what every bot message shows, by (chat_id, message_id), kept for `ttl` seconds after the last edit"""
+
+    def __init__(self, ttl=3600, max_size=50000, clock=time.monotonic):
+        self.__ttl = ttl
+        self.__max_size = max_size
+        self.__clock = clock
+        self.__entries = OrderedDict()  # (chat_id, message_id) -> (hash, expires_at)
+        self.__lock = threading.Lock()
+        self.__counters = {'skipped': 0, 'rendered': 0}
+
+    def is_unchanged(self, chat_id, message_id, content_hash):
+        with self.__lock:
+            entry = self.__entries.get((chat_id, message_id))
+            if entry is not None and entry[1] <= self.__clock():
+                del self.__entries[(chat_id, message_id)]
+                entry = None
+            unchanged = entry is not None and entry[0] == content_hash
+            if unchanged:
+                self.__counters['skipped'] += 1
+            return unchanged
+
+    def put(self, chat_id, message_id, content_hash):
+        with self.__lock:
+            self.__entries[(chat_id, message_id)] = (content_hash, self.__clock() + self.__ttl)
+            self.__entries.move_to_end((chat_id, message_id))
+            self.__counters['rendered'] += 1
+            # Entries are in order of expiry, the oldest ones are evicted first
+            now = self.__clock()
+            while self.__entries and (len(self.__entries) > self.__max_size or next(iter(self.__entries.values()))[1] <= now):
+                self.__entries.popitem(last=False)
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__counters)
+            stats['size'] = len(self.__entries)
+        return stats
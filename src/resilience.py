@@ -0,0 +1,130 @@
+import logging
+import random
+import threading
+import time
+
+from src.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+breaker_transitions = registry.counter(
+    'bot_circuit_breaker_transitions_total',
+    'Circuit breaker state changes',
+    ('dependency', 'state')
+)
+upstream_retries = registry.counter('bot_upstream_retries_total', 'Retried upstream calls', ('dependency',))
+
+breakers = {}  # name -> CircuitBreaker, for the state gauge
+
+
+class CircuitOpenError(Exception):
+    """The dependency is failing, the call wasn't made"""
+
+
+class CircuitBreaker:
+    """
+    Closed: calls go through, `failure_threshold` failures in a row open the circuit.
+    Open: calls fail right away with CircuitOpenError for `reset_timeout` seconds.
+    Half-open: one trial call goes through, its success closes the circuit, its failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.__clock = clock
+        self.__failures = 0
+        self.__opened_at = 0
+        self.__trial_running = False
+        self.__lock = threading.Lock()
+        breakers[name] = self
+
+    def call(self, fn, *args, **kwargs):
+        with self.__lock:
+            if self.state == self.OPEN and self.__clock() - self.__opened_at >= self.reset_timeout:
+                self.__set_state(self.HALF_OPEN)
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and self.__trial_running):
+                raise CircuitOpenError(f'{self.name} is unavailable, circuit is open')
+            if self.state == self.HALF_OPEN:
+                self.__trial_running = True
+
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            with self.__lock:
+                self.__trial_running = False
+                self.__failures += 1
+                if self.state == self.HALF_OPEN or self.__failures >= self.failure_threshold:
+                    self.__opened_at = self.__clock()
+                    self.__set_state(self.OPEN)
+            raise
+
+        with self.__lock:
+            self.__trial_running = False
+            self.__failures = 0
+            if self.state != self.CLOSED:
+                self.__set_state(self.CLOSED)
+        return result
+
+    def __set_state(self, state):
+        # called with self.__lock held
+        if state == self.OPEN:
+            logger.warning(f'Circuit {self.name} is open after {self.__failures} failures, retrying in {self.reset_timeout}s')
+        else:
+            logger.info(f'Circuit {self.name} is {state}')
+        self.state = state
+        breaker_transitions.inc(self.name, state)
+
+
+def retry(name, fn, *args, attempts=3, base_delay=0.5, max_delay=5, **kwargs):
+    """Calls fn up to `attempts` times, sleeping a random 0..base_delay * 2^attempt (at most max_delay) in between"""
+    for attempt in range(attempts):
+        try:
+            return fn(*args, **kwargs)
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            if attempt + 1 >= attempts:
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))  # full jitter
+            logger.warning(f'{name} failed ({type(e).__name__}: {e}), retrying in {delay:.2f}s')
+            upstream_retries.inc(name)
+            time.sleep(delay)
+
+
+class ResilientCall:
+    """A circuit breaker around bounded retries, configured by a dict of config.resilience"""
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, attempts=3, base_delay=0.5, max_delay=5):
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.__attempts = attempts
+        self.__base_delay = base_delay
+        self.__max_delay = max_delay
+
+    def __call__(self, fn, *args, **kwargs):
+        # The breaker counts a call that failed every attempt as one failure
+        return self.breaker.call(
+            retry,
+            self.breaker.name,
+            fn,
+            *args,
+            attempts=self.__attempts,
+            base_delay=self.__base_delay,
+            max_delay=self.__max_delay,
+            **kwargs
+        )
+
+
+STATES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+registry.gauge(
+    'bot_circuit_breaker_state',
+    'Circuit breaker state: 0 closed, 1 half-open, 2 open',
+    ('dependency',),
+    lambda: {(name,): STATES[breaker.state] for name, breaker in list(breakers.items())}
+)
@@ -0,0 +1,46 @@
+import importlib
+import os
+
+import env
+
+
+def build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
+    menu = [buttons[i:i + n_cols] for i in range(0, len(buttons), n_cols)]
+    if header_buttons:
+        menu.insert(0, header_buttons)
+    if footer_buttons:
+        menu.append(footer_buttons)
+    return menu
+
+
+class Screens:
+    """Static texts and keyboards, built once at startup and again when env.py changes"""
+
+    def __init__(self, builders):
+        self.__builders = builders  # name -> callable returning the screen
+        self.__env_mtime = self.get_env_mtime()
+        self.__screens = {}
+        self.build()
+
+    @staticmethod
+    def get_env_mtime():
+        try:
+            return os.path.getmtime(env.__file__)
+        except (AttributeError, OSError):
+            return None
+
+    def build(self):
+        # Swapped in one assignment, so readers never see a half-built set
+        self.__screens = {name: builder() for name, builder in self.__builders.items()}
+
+    def reload_if_changed(self):
+        env_mtime = self.get_env_mtime()
+        if env_mtime == self.__env_mtime:
+            return False
+        importlib.reload(env)
+        self.__env_mtime = env_mtime
+        self.build()
+        return True
+
+    def __getitem__(self, name):
+        return self.__screens[name]
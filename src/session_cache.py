@@ -0,0 +1,49 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class SessionCache:
+    """LRU cache of authenticated users by chat_id, every entry expires with the user's authorization"""
+
+    def __init__(self, max_size=10000, clock=time.time):
+        self.__max_size = max_size
+        self.__clock = clock
+        self.__entries = OrderedDict()  # chat_id -> (user, expires_at)
+        self.__lock = threading.Lock()
+        self.__counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, chat_id):
+        with self.__lock:
+            entry = self.__entries.get(chat_id)
+            if entry is not None and entry[1] <= self.__clock():
+                del self.__entries[chat_id]
+                entry = None
+            if entry is None:
+                self.__counters['misses'] += 1
+                return None
+            self.__entries.move_to_end(chat_id)
+            self.__counters['hits'] += 1
+            return entry[0]
+
+    def put(self, chat_id, user, expires_at):
+        with self.__lock:
+            self.__entries[chat_id] = (user, expires_at)
+            self.__entries.move_to_end(chat_id)
+            while len(self.__entries) > self.__max_size:
+                self.__entries.popitem(last=False)
+                self.__counters['evictions'] += 1
+
+    def invalidate(self, chat_id):
+        with self.__lock:
+            self.__entries.pop(chat_id, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__counters)
+            stats['size'] = len(self.__entries)
+        return stats
@@ -0,0 +1,272 @@
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+import zlib
+
+import config as config_global
+import env
+from src.activity_log import update_to_dict
+from src.database import Database
+from src.metrics import registry, start_metrics_server
+from src.startup import configure_logging
+from src.webhook import check_secret_token
+
+logger = logging.getLogger(__name__)
+
+'''
+Sharded mode, enabled by config.sharding['shards'] > 1:
+
+    ingress (polling or webhook) --chat_id hash--> queue 0 --> bot process 0 (also runs the jobs)
+                                               --> queue 1 --> bot process 1
+                                               ...
+
+Every chat always goes to the same process, which handles its updates one by one, so their order is kept.
+Bot processes share database.db (SQLite WAL allows several processes) but have their own caches.
+'''
+
+
+def get_shard(update, shards):
+    if update.effective_chat is not None:
+        key = update.effective_chat.id
+    elif update.effective_user is not None:
+        key = update.effective_user.id
+    else:
+        key = 0
+    return zlib.crc32(str(key).encode('utf-8')) % shards
+
+
+def run_worker(shard, shards, updates, processed, db_path):
+    """Bot process: handles the updates of its shard until it gets None"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C reaches the whole process group, the supervisor stops us
+    configure_logging()
+
+    from telegram import Update
+    from src.bot import Bot
+
+    # Each process has its own outbound queue, together they must stay within the global flood limit
+    config_global.outbound = dict(config_global.outbound, global_rate=config_global.outbound['global_rate'] / shards)
+    bot = Bot(db_path=db_path)
+    bot.register_signal_handlers()
+    bot.start_jobs(primary=shard == 0)
+    telegram_bot = bot.dispatcher.bot
+    logger.info(f'Shard {shard} is ready')
+
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        try:
+            bot.dispatcher.process_update(Update.de_json(data, telegram_bot))
+        except Exception:
+            logger.exception(f'Shard {shard} could not process update {data.get("update_id")}')
+        processed.value += 1  # only this process writes it
+    bot.job_queue.stop()  # its thread isn't a daemon, the process wouldn't exit
+    bot.close()
+
+
+class ShardSupervisor:
+    """Receives updates, hands them to the bot processes by chat_id, restarts processes that died"""
+
+    def __init__(self, shards, db_path='database.db'):
+        settings = config_global.sharding
+        # spawn: bot processes start clean, without copies of this process' threads and locks
+        self.__context = multiprocessing.get_context('spawn')
+        self.__shards = shards
+        self.__db_path = db_path
+        self.__restart_delay = settings['restart_delay']
+        self.__report_interval = settings['report_interval']
+        self.__queue_size = settings['queue_size']
+        self.__queues = [self.__context.Queue(self.__queue_size) for _ in range(shards)]
+        # No lock: a killed process could leave it held, and there's a single writer per shard anyway
+        self.__processed = [self.__context.RawValue('q', 0) for _ in range(shards)]
+        self.__processes = [None] * shards
+        self.__started_at = [0] * shards
+        self.__restarts = [0] * shards
+        self.__routed = [0] * shards
+        self.__lost = [0] * shards
+        self.__stop = threading.Event()
+        self.running = False
+        registry.gauge(
+            'bot_shard',
+            'Per-shard load: updates routed, processed, queued and lost, process restarts',
+            ('shard', 'stat'),
+            lambda: {(shard, key): value for shard, stats in self.stats().items() for key, value in stats.items()}
+        )
+
+    # WebhookServer takes the supervisor as its dispatcher: update_queue.put(), update_queue.empty() and running
+
+    @property
+    def update_queue(self):
+        return self
+
+    def put(self, update):
+        shard = get_shard(update, self.__shards)
+        data = update_to_dict(update)
+        while True:
+            # A full queue blocks ingress until the bot process catches up, or until it's replaced after a crash
+            try:
+                self.__queues[shard].put(data, timeout=1)
+                break
+            except queue.Full:
+                if self.__stop.is_set():
+                    self.__lost[shard] += 1
+                    return
+        self.__routed[shard] += 1
+
+    def empty(self):
+        return all(updates.empty() for updates in self.__queues)
+
+    def stats(self):
+        return {
+            shard: {
+                'routed': self.__routed[shard],
+                'processed': self.__processed[shard].value,
+                'queued': self.__queues[shard].qsize(),
+                'restarts': self.__restarts[shard],
+                'lost': self.__lost[shard],
+                'alive': int(self.__processes[shard] is not None and self.__processes[shard].is_alive()),
+            }
+            for shard in range(self.__shards)
+        }
+
+    def start_worker(self, shard):
+        process = self.__context.Process(
+            target=run_worker,
+            args=(shard, self.__shards, self.__queues[shard], self.__processed[shard], self.__db_path),
+            name=f'shard-{shard}',
+            daemon=True
+        )
+        process.start()
+        self.__processes[shard] = process
+        self.__started_at[shard] = time.monotonic()
+
+    def restart_worker(self, shard):
+        # A process killed while waiting in get() keeps the queue's read lock forever, nobody could read it again.
+        # The new process gets a new queue, and what was left in the old one can't be taken out: it's counted as lost
+        stranded = self.__queues[shard]
+        self.__queues[shard] = self.__context.Queue(self.__queue_size)
+        lost = stranded.qsize()
+        self.__lost[shard] += lost
+        logger.error(
+            f'Shard {shard} exited with code {self.__processes[shard].exitcode}, restarting it, {lost} queued updates lost'
+        )
+        stranded.cancel_join_thread()  # nobody will read it, don't wait for its feeder on exit
+        stranded.close()
+        self.__restarts[shard] += 1
+        self.start_worker(shard)
+
+    def forward_signal(self, signum):
+        for process in self.__processes:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signum)
+
+    def watch(self):
+        # Restarts dead bot processes and logs the load of every shard
+        last_report = time.monotonic()
+        last_processed = [0] * self.__shards
+        while not self.__stop.wait(1):
+            for shard, process in enumerate(self.__processes):
+                # A process that keeps crashing on start is restarted at most every restart_delay seconds
+                if not process.is_alive() and time.monotonic() - self.__started_at[shard] >= self.__restart_delay:
+                    self.restart_worker(shard)
+
+            if time.monotonic() - last_report >= self.__report_interval:
+                elapsed = time.monotonic() - last_report
+                last_report = time.monotonic()
+                for shard, stats in self.stats().items():
+                    rate = (stats['processed'] - last_processed[shard]) / elapsed
+                    last_processed[shard] = stats['processed']
+                    logger.info(
+                        f"Shard {shard}: {rate:.1f} updates/s, {stats['queued']} queued, "
+                        f"{stats['processed']} processed, {stats['restarts']} restarts, {stats['lost']} lost"
+                    )
+
+    def run(self):
+        from telegram import Bot as TelegramBot
+        from src.telegram_request import InstrumentedRequest
+
+        if config_global.webhook['enabled']:
+            check_secret_token(env.webhook_secret_token)  # before any bot process is started
+        Database(self.__db_path).close()  # migrations run here once, not in every bot process at the same time
+        for shard in range(self.__shards):
+            self.start_worker(shard)
+        threading.Thread(target=self.watch, name='shard-watch', daemon=True).start()
+        if config_global.metrics['enabled']:
+            start_metrics_server(config_global.metrics['listen'], config_global.metrics['port'])
+
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+            signal.signal(signum, lambda signum, frame: self.__stop.set())
+        if hasattr(signal, 'SIGUSR2'):
+            # kill -USR2 <supervisor pid> profiles every bot process, each writes its own file
+            signal.signal(signal.SIGUSR2, lambda signum, frame: self.forward_signal(signum))
+
+        telegram_bot = TelegramBot(
+            env.telegram_bot_token,
+            base_url=getattr(env, 'telegram_base_url', None),
+            request=InstrumentedRequest(con_pool_size=4)
+        )
+        self.running = True
+        if config_global.webhook['enabled']:
+            self.serve_webhook(telegram_bot)
+        else:
+            self.poll(telegram_bot)
+        self.running = False
+        self.stop()
+
+    def poll(self, telegram_bot, timeout=30):
+        from telegram.error import NetworkError
+
+        telegram_bot.delete_webhook()
+        # Updates received while the bot was down are dropped, as Updater.start_polling(clean=True) does
+        pending = telegram_bot.get_updates()
+        offset = pending[-1].update_id + 1 if pending else None
+        logger.info(f'Polling for {self.__shards} shards')
+        while not self.__stop.is_set():
+            try:
+                updates = telegram_bot.get_updates(offset=offset, timeout=timeout)
+            except NetworkError as e:  # TimedOut is a NetworkError too
+                logger.warning(f'getUpdates failed: {e}')
+                self.__stop.wait(1)
+                continue
+            for update in updates:
+                self.put(update)
+                offset = update.update_id + 1
+
+    def serve_webhook(self, telegram_bot):
+        from src.webhook import WebhookServer
+
+        webhook = WebhookServer(
+            telegram_bot,
+            self,
+            env.webhook_secret_token,
+            listen=config_global.webhook['listen'],
+            port=config_global.webhook['port'],
+            path=config_global.webhook['path']
+        )
+        webhook.add_get_route('/metrics', lambda: (200, 'text/plain; version=0.0.4; charset=utf-8', registry.render()))
+        webhook.start()
+        webhook.set_webhook(env.webhook_url)
+        logger.info(f'Webhook listening for {self.__shards} shards')
+        self.__stop.wait()
+        webhook.drain(config_global.webhook['drain_timeout'])
+        webhook.stop()
+
+    def stop(self, timeout=30):
+        """Lets every bot process finish its queue, then stops it"""
+        self.__stop.set()
+        deadline = time.monotonic() + timeout
+        for shard, updates in enumerate(self.__queues):
+            # A dead or stuck process never makes room in its queue: it's terminated below instead
+            try:
+                updates.put(None, timeout=max(0, deadline - time.monotonic()))
+            except queue.Full:
+                logger.warning(f'Shard {shard} queue is full, {updates.qsize()} queued updates will be lost')
+        for shard, process in enumerate(self.__processes):
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f'Shard {shard} did not stop in time, terminating it')
+                process.terminate()
@@ -0,0 +1,69 @@
+import threading
+
+from src.metrics import registry
+
+single_flight_calls = registry.counter(
+    'bot_single_flight_calls_total',
+    'Calls through single-flight groups: "leader" went upstream, "coalesced" shared its result',
+    ('group', 'outcome')
+)
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share one upstream call: the first caller makes it,
+    the others wait for its result or exception. Nothing is cached once the call has returned.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.__calls = {}  # key -> Call in flight
+        self.__lock = threading.Lock()
+        self.__counters = {'leader': 0, 'coalesced': 0, 'timeout': 0}
+
+    def do(self, key, fn, *args, timeout=None, **kwargs):
+        """Returns fn(*args, **kwargs), raises TimeoutError if a shared call takes longer than `timeout`"""
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.__calls[key] = Call()
+            self.__count('leader' if leader else 'coalesced')
+
+        if not leader:
+            if not call.done.wait(timeout):
+                with self.__lock:
+                    self.__count('timeout')
+                raise TimeoutError(f'{self.name}: call for {key!r} is still in flight after {timeout}s')
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:  # e.g. KeyboardInterrupt: waiters must not take it for a None result
+            call.error = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call.done.set()
+
+    def __count(self, outcome):
+        # called with self.__lock held
+        self.__counters[outcome] += 1
+        single_flight_calls.inc(self.name, outcome)
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__counters)
+            stats['in_flight'] = len(self.__calls)
+        return stats
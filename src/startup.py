@@ -0,0 +1,33 @@
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+def configure_logging():
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(processName)s %(name)s: %(message)s', level=logging.INFO)
+
+
+class StartupReport:
+    """Wall time of every startup phase, logged once the bot is ready to take updates"""
+
+    def __init__(self):
+        self.phases = []  # [(name, seconds), ...] in order
+        self.__started = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    @property
+    def total(self):
+        return time.perf_counter() - self.__started
+
+    def log(self):
+        phases = ', '.join(f'{name} {seconds * 1000:.0f}ms' for name, seconds in self.phases)
+        logger.info(f'Started in {self.total * 1000:.0f}ms: {phases}')
@@ -0,0 +1,27 @@
+import sys
+
+sys.path.append("../")
+
+from src.database import Database
+from src.employees import EmployeeRepository
+from src.google_spreadsheet import GoogleSpreadsheetReader
+
+# Usage: python src/sync.py [--status]
+if __name__ == '__main__':
+    employees = EmployeeRepository(Database('database.db'))
+
+    if '--status' not in sys.argv[1:]:
+        # A real download: get_all_records() could serve the snapshot saved by the bot, however old it is
+        try:
+            snapshot = GoogleSpreadsheetReader().refresh()
+        except Exception as e:
+            print(f'Could not download the spreadsheet: {type(e).__name__}: {e}', file=sys.stderr)
+            sys.exit(1)
+        employees.sync(snapshot.records)
+
+    last_sync = employees.last_sync()
+    if last_sync is None:
+        print('Employees have never been synced')
+    else:
+        for key, value in last_sync.items():
+            print(f'{key}: {value}')
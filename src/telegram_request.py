@@ -0,0 +1,19 @@
+from telegram.utils.request import Request
+
+from src.metrics import track_upstream
+
+
+class InstrumentedRequest(Request):
+    """Records latency and errors of every Bot API call, labelled with the API method"""
+
+    def get(self, url, timeout=None):
+        with track_upstream('telegram', url.rsplit('/', 1)[-1]):
+            return super().get(url, timeout=timeout)
+
+    def post(self, url, data, timeout=None):
+        with track_upstream('telegram', url.rsplit('/', 1)[-1]):
+            return super().post(url, data, timeout=timeout)
+
+    def retrieve(self, url, timeout=None):
+        with track_upstream('telegram', 'getFile'):
+            return super().retrieve(url, timeout=timeout)
@@ -0,0 +1,111 @@
+import threading
+from collections import Counter
+
+from src.menu import parse_callback
+
+
+def get_action(callback, message, kind):
+    """What the user did: the button pressed, the command sent, or the kind of message"""
+    if callback:
+        return parse_callback(callback)[1]  # without version and parameters
+    if message and (kind == 'command' or (kind is None and message.startswith('/'))):
+        return message.split()[0]
+    return kind or 'message'
+
+
+class UsageRollup:
+    """
+    Per-hour counts by action and per-day counts by action and user, folded in from activity_log.
+    Every batch and its checkpoint are written in one transaction, so a row is never counted twice.
+    """
+
+    CHECKPOINT = 'usage'
+
+    def __init__(self, db, batch_size=5000):
+        self.__db = db
+        self.__batch_size = batch_size
+        self.__lock = threading.Lock()
+
+    def checkpoint(self):
+        row = self.__db.execute('SELECT last_id FROM rollup_checkpoints WHERE name = ?', self.CHECKPOINT).fetchone()
+        return 0 if row is None else row['last_id']
+
+    def catch_up(self):
+        """Rolls up every activity_log row written since the last run, returns the number of rows"""
+        with self.__lock:
+            total = 0
+            last_id = self.checkpoint()
+            while True:
+                rows = self.__db.execute(
+                    """
+                        SELECT id, user_id, kind, callback, message, when_created
+                        FROM activity_log
+                        WHERE id > ?
+                        ORDER BY id
+                        LIMIT ?
+                    """,
+                    last_id,
+                    self.__batch_size
+                ).fetchall()
+                if not rows:
+                    return total
+                last_id = rows[-1]['id']
+                self.__write(rows, last_id)
+                total += len(rows)
+
+    def __write(self, rows, last_id):
+        hourly = Counter()
+        daily = Counter()
+        for row in rows:
+            action = get_action(row['callback'], row['message'], row['kind'])
+            hourly[(row['when_created'][:13] + ':00', action)] += 1
+            daily[(row['when_created'][:10], action, row['user_id'])] += 1
+
+        # INSERT OR IGNORE + UPDATE instead of upsert, which needs SQLite 3.24
+        with self.__db.transaction() as cur:
+            cur.executemany('INSERT OR IGNORE INTO usage_hourly(hour, callback, count) VALUES(?, ?, 0)', hourly)
+            cur.executemany(
+                'UPDATE usage_hourly SET count = count + ? WHERE hour = ? AND callback = ?',
+                [(count, hour, action) for (hour, action), count in hourly.items()]
+            )
+            cur.executemany('INSERT OR IGNORE INTO usage_daily(day, callback, user_id, count) VALUES(?, ?, ?, 0)', daily)
+            cur.executemany(
+                'UPDATE usage_daily SET count = count + ? WHERE day = ? AND callback = ? AND user_id = ?',
+                [(count, day, action, user_id) for (day, action, user_id), count in daily.items()]
+            )
+            cur.execute(
+                'INSERT OR REPLACE INTO rollup_checkpoints(name, last_id) VALUES(?, ?)',
+                (self.CHECKPOINT, last_id)
+            )
+
+    def get_daily(self, since):
+        """Returns [(action, count, users), ...] since the day `since`, most used first"""
+        return [
+            (row['callback'], row['count'], row['users'])
+            for row in self.__db.execute(
+                """
+                    SELECT usage_daily.callback, SUM(usage_daily.count) AS count, COUNT(DISTINCT usage_daily.user_id) AS users
+                    FROM usage_daily
+                    WHERE usage_daily.day >= ?
+                    GROUP BY usage_daily.callback
+                    ORDER BY count DESC
+                """,
+                since.strftime('%Y-%m-%d')
+            )
+        ]
+
+    def get_hourly(self, since):
+        """Returns [(hour, count), ...] of all actions since the datetime `since`"""
+        return [
+            (row['hour'], row['count'])
+            for row in self.__db.execute(
+                """
+                    SELECT usage_hourly.hour, SUM(usage_hourly.count) AS count
+                    FROM usage_hourly
+                    WHERE usage_hourly.hour >= ?
+                    GROUP BY usage_hourly.hour
+                    ORDER BY usage_hourly.hour
+                """,
+                since.strftime('%Y-%m-%d %H:00')
+            )
+        ]
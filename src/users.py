@@ -0,0 +1,138 @@
+import datetime
+
+from src.utils import normalize_phone_number
+
+AUTHORIZATION_DAYS = 7
+
+
+class UserRepository:
+    """Lookups on the users table, each one served by its own index"""
+
+    COLUMNS = 'users.user_id, users.phone_number, users.first_name, users.last_name'
+
+    def __init__(self, db):
+        self.__db = db
+
+    def get_by_id(self, user_id):
+        return self.__db.execute(
+            f"""
+                SELECT {self.COLUMNS}
+                FROM users
+                WHERE users.user_id = ?
+            """,
+            user_id
+        ).fetchone()
+
+    def get_by_phone_number(self, phone_number):
+        return self.__db.execute(
+            f"""
+                SELECT {self.COLUMNS}
+                FROM users
+                WHERE users.phone_number = ?
+                LIMIT 1
+            """,
+            normalize_phone_number(phone_number)
+        ).fetchone()
+
+    def get_authorized_by_phone_numbers(self, phone_numbers, batch_size=500):
+        # Returns {phone_number: user_id} of authorized users, batched to stay under SQLite's limit of query parameters
+        phone_numbers = [normalize_phone_number(phone_number) for phone_number in phone_numbers]
+        user_ids = {}
+        for start in range(0, len(phone_numbers), batch_size):
+            batch = phone_numbers[start:start + batch_size]
+            rows = self.__db.execute(
+                f"""
+                    SELECT users.phone_number, users.user_id
+                    FROM users
+                    WHERE users.phone_number IN ({', '.join('?' * len(batch))})
+                        AND users.when_authorized IS NOT NULL
+                """,
+                *batch
+            ).fetchall()
+            user_ids.update((row['phone_number'], row['user_id']) for row in rows)
+        return user_ids
+
+    def get_by_full_name(self, first_name, last_name):
+        return self.__db.execute(
+            f"""
+                SELECT {self.COLUMNS}
+                FROM users
+                WHERE users.first_name = ?
+                    AND users.last_name = ?
+                LIMIT 1
+            """,
+            first_name,
+            last_name
+        ).fetchone()
+
+    def get_authorized_until(self, user_id):
+        # Returns UTC timestamp when authorization of the user expires, None if it already has
+        row = self.__db.execute(
+            f"""
+                SELECT datetime(users.when_authorized, '+{AUTHORIZATION_DAYS} days') AS authorized_until
+                FROM users
+                WHERE users.user_id = ?
+                    AND users.when_authorized IS NOT NULL
+            """,
+            user_id
+        ).fetchone()
+        if row is None:
+            return None
+        authorized_until = datetime.datetime.strptime(row['authorized_until'], '%Y-%m-%d %H:%M:%S')
+        authorized_until = authorized_until.replace(tzinfo=datetime.timezone.utc).timestamp()
+        # expire_authorizations() runs periodically, users past the window may not be cleared yet
+        return authorized_until if authorized_until > datetime.datetime.now(datetime.timezone.utc).timestamp() else None
+
+    def iter_authorized_user_ids(self, batch_size=500):
+        # Streams ids instead of loading the whole table, e.g. for broadcasts
+        cur = self.__db.execute(
+            """
+                SELECT users.user_id
+                FROM users
+                WHERE users.when_authorized IS NOT NULL
+            """
+        )
+        try:
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield row['user_id']
+        finally:
+            cur.close()
+
+    def create(self, user_id, first_name, last_name, phone_number):
+        self.__db.execute(
+            """
+                INSERT INTO users(first_name, last_name, phone_number, user_id)
+                VALUES(?, ?, ?, ?)
+            """,
+            first_name,
+            last_name,
+            normalize_phone_number(phone_number),
+            user_id
+        )
+
+    def authorize(self, user_id, phone_number):
+        self.__db.execute(
+            """
+                UPDATE users
+                SET
+                    phone_number = ?,
+                    when_authorized = datetime('now')
+                WHERE users.user_id = ?
+            """,
+            normalize_phone_number(phone_number),
+            user_id
+        )
+
+    def expire_authorizations(self):
+        # Unauthorize users who exceed max authorization timespan
+        return self.__db.execute(
+            f"""
+                UPDATE users
+                SET when_authorized = NULL
+                WHERE users.when_authorized < datetime('now', '-{AUTHORIZATION_DAYS} days')
+            """
+        ).rowcount
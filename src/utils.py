@@ -1,13 +1,66 @@
 import datetime
-import requests
-from bs4 import BeautifulSoup
+
+import config as config_global
+from src.metrics import track_upstream
+from src.resilience import ResilientCall
+from src.single_flight import SingleFlight
+
+EXCHANGE_RATES_URL = 'http://www.bnm.md/md/official_exchange_rates?get_xml=1&date={date}'
+
+# Keeps connections to bnm.md alive between calls
+_session = None
+
+
+def get_session():
+    global _session
+    if _session is None:
+        import requests  # imported on first use, it's slow to import at startup
+        _session = requests.Session()
+    return _session
+
+
+# Concurrent requests for the same date share one call to bnm.md, retried and failing fast while bnm.md is down
+exchange_rates_flight = SingleFlight('bnm')
+exchange_rates_upstream = ResilientCall('bnm', **config_global.resilience['bnm'])
+
+
+def get_exchange_rates(date: datetime, timeout=10):
+    """Returns {currency_id: {'char_code', 'nominal', 'value'}} for every currency published on the date"""
+    return exchange_rates_flight.do(
+        date.strftime('%Y-%m-%d'),
+        exchange_rates_upstream,
+        fetch_exchange_rates,
+        date,
+        timeout,
+        timeout=timeout
+    )
+
+
+def fetch_exchange_rates(date: datetime, timeout=10):
+    from lxml import etree
+
+    rates = {}
+    url = EXCHANGE_RATES_URL.format(date=date.strftime("%d.%m.%Y"))
+    with track_upstream('bnm', 'get_exchange_rates'), get_session().get(url, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        for _, valute in etree.iterparse(r.raw, tag='Valute'):
+            rates[int(valute.get('ID'))] = {
+                'char_code': valute.findtext('CharCode'),
+                'nominal': int(valute.findtext('Nominal') or 1),
+                'value': valute.findtext('Value'),
+            }
+            valute.clear()
+    return rates
 
 
 def get_exchange_rate(currency_code: int, date: datetime):
-    r = requests.get(f'http://www.bnm.md/md/official_exchange_rates?get_xml=1&date={date.strftime("%d.%m.%Y")}')
-    exchange_rate = BeautifulSoup(r.text, 'lxml').find_all(
-        'valute', {
-            'id': str(currency_code)
-        }
-    )[0].value.text
-    return exchange_rate
+    try:
+        return get_exchange_rates(date)[currency_code]['value']
+    except KeyError:
+        raise IndexError(f'Currency {currency_code} is missing in the response')
+
+
+def normalize_phone_number(phone_number):
+    # Telegram sends contacts without "+", while the spreadsheet may contain spaces, dashes, etc.
+    return ''.join(char for char in str(phone_number) if char.isdigit())
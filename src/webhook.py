@@ -0,0 +1,132 @@
+import hmac
+import json
+import logging
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+from telegram import Update
+
+from src.http_server import ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# https://core.telegram.org/bots/api#setwebhook
+SECRET_TOKEN_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,256}')
+
+
+def check_secret_token(secret_token):
+    # Without the secret anyone reaching the port could post updates, e.g. /broadcast from an admin's id
+    if not SECRET_TOKEN_PATTERN.fullmatch(secret_token or ''):
+        raise ValueError('env.webhook_secret_token must be 1-256 characters A-Z, a-z, 0-9, _ and -')
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    # self.server.webhook is the WebhookServer this listener belongs to
+
+    def do_GET(self):
+        webhook = self.server.webhook
+        if self.path == '/healthz':
+            self.respond(200, 'ok')
+        elif self.path == '/readyz':
+            if webhook.is_ready():
+                self.respond(200, 'ready')
+            else:
+                self.respond(503, 'not ready')
+        elif self.path in webhook.get_routes:
+            status, content_type, body = webhook.get_routes[self.path]()
+            self.respond(status, body, content_type)
+        else:
+            self.respond(404, 'not found')
+
+    def do_POST(self):
+        webhook = self.server.webhook
+        if self.path != webhook.path:
+            return self.respond(404, 'not found')
+        if not hmac.compare_digest(self.headers.get(SECRET_TOKEN_HEADER, ''), webhook.secret_token):
+            return self.respond(403, 'forbidden')
+        if webhook.draining:
+            return self.respond(503, 'shutting down')  # Telegram will redeliver the update later
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            return self.respond(400, 'bad request')
+        if not isinstance(data, dict):
+            return self.respond(400, 'bad request')
+
+        try:
+            webhook.put(data)
+        except Exception:
+            logger.warning('Webhook body is not a valid update', exc_info=True)
+            return self.respond(400, 'bad request')
+        self.respond(200, 'ok')
+
+    def respond(self, status, body, content_type='text/plain; charset=utf-8'):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class WebhookServer:
+    """Local HTTP listener for Telegram webhook updates, with health and readiness endpoints"""
+
+    def __init__(self, bot, dispatcher, secret_token, listen='0.0.0.0', port=8443, path='/telegram'):
+        check_secret_token(secret_token)
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.secret_token = secret_token
+        self.path = path
+        self.draining = False
+        self.get_routes = {}  # path -> callable returning (status, content_type, body)
+        self.__httpd = ThreadingHTTPServer((listen, port), WebhookRequestHandler)
+        self.__httpd.webhook = self
+        self.__thread = None
+
+    @property
+    def port(self):
+        return self.__httpd.server_address[1]
+
+    def add_get_route(self, path, callback):
+        self.get_routes[path] = callback
+
+    def put(self, data):
+        self.dispatcher.update_queue.put(Update.de_json(data, self.bot))
+
+    def is_ready(self):
+        return self.dispatcher.running and not self.draining
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__httpd.serve_forever, name='webhook', daemon=True)
+        self.__thread.start()
+
+    def set_webhook(self, url, timeout=10):
+        # python-telegram-bot doesn't know about secret_token yet, so Bot API is called directly
+        import requests
+
+        response = requests.post(
+            f'{self.bot.base_url}/setWebhook',
+            json={'url': url, 'secret_token': self.secret_token},
+            timeout=timeout
+        )
+        response.raise_for_status()
+
+    def drain(self, timeout=30):
+        """Stops accepting updates and waits until the dispatcher has taken everything already queued"""
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        while not self.dispatcher.update_queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+    def stop(self):
+        self.__httpd.shutdown()
+        self.__httpd.server_close()
@@ -0,0 +1,47 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class ChatWorkerPool:
+    """Bounded thread pool: tasks of one chat run one after another, different chats run in parallel"""
+
+    def __init__(self, size=8):
+        self.__executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='chat-worker')
+        self.__pending = {}  # chat_id -> deque of tasks waiting for the running one
+        self.__lock = threading.Lock()
+
+    def submit(self, chat_id, task):
+        with self.__lock:
+            if chat_id in self.__pending:
+                self.__pending[chat_id].append(task)
+                return
+            self.__pending[chat_id] = deque()
+        self.__executor.submit(self.__run, chat_id, task)
+
+    def __run(self, chat_id, task):
+        while True:
+            try:
+                task()
+            except Exception:
+                logger.exception(f'Task for chat {chat_id} failed')
+
+            with self.__lock:
+                pending = self.__pending[chat_id]
+                if not pending:
+                    del self.__pending[chat_id]
+                    return
+                task = pending.popleft()
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'active_chats': len(self.__pending),
+                'queued': sum(len(pending) for pending in self.__pending.values()),
+            }
+
+    def shutdown(self, wait=True):
+        self.__executor.shutdown(wait=wait)
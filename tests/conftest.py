@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# Modules are imported as src.<module>, the way the bot runs them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeClock:
+    # Passed as `clock=` instead of time.monotonic, tests move time by setting `now`
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
@@ -0,0 +1,88 @@
+import threading
+import time
+
+import pytest
+
+try:
+    from telegram.error import RetryAfter
+
+    from src.outbound import OutboundQueue, TokenBucket
+except ImportError as e:  # src.outbound needs python-telegram-bot for RetryAfter
+    pytest.skip(f'python-telegram-bot is not importable: {e}', allow_module_level=True)
+
+
+def test_bucket_allows_a_burst_of_capacity_then_waits(clock):
+    bucket = TokenBucket(rate=2, capacity=3, clock=clock)
+    assert [bucket.take() for _ in range(3)] == [0, 0, 0]
+    assert bucket.take() == pytest.approx(0.5)  # one token at 2 per second
+    assert not bucket.is_full
+
+
+def test_bucket_refills_with_time_up_to_capacity(clock):
+    bucket = TokenBucket(rate=2, capacity=3, clock=clock)
+    for _ in range(3):
+        bucket.take()
+    clock.now = 0.25
+    assert bucket.take() == pytest.approx(0.25)  # half a token so far
+    clock.now = 0.5
+    assert bucket.take() == 0
+    clock.now = 100
+    assert bucket.is_full
+    assert bucket.tokens == 3
+
+
+class FakeSend:
+    """Stands for bot.send_message: records chat ids, raises what `errors` holds for the first calls"""
+
+    def __init__(self, expected, errors=()):
+        self.chat_ids = []
+        self.times = []
+        self.errors = list(errors)
+        self.expected = expected
+        self.done = threading.Event()
+
+    def __call__(self, chat_id, **kwargs):
+        self.chat_ids.append(chat_id)
+        self.times.append(time.monotonic())
+        if len(self.chat_ids) == self.expected:
+            self.done.set()
+        if self.errors:
+            raise self.errors.pop(0)
+
+
+def test_interactive_messages_go_ahead_of_queued_broadcasts():
+    send = FakeSend(expected=5)
+    outbound = OutboundQueue(global_rate=1000)
+    for chat_id in (1, 2, 3):
+        outbound.send(send, priority=OutboundQueue.BROADCAST, chat_id=chat_id, text='News')
+    for chat_id in (4, 5):
+        outbound.send(send, chat_id=chat_id, text='Menu')
+    outbound.start()
+    assert send.done.wait(5)
+    outbound.stop()
+    assert send.chat_ids == [4, 5, 1, 2, 3]
+
+
+def test_retry_after_pauses_sending_and_requeues_the_message_first():
+    send = FakeSend(expected=3, errors=[RetryAfter(0.05)])
+    outbound = OutboundQueue(global_rate=1000)
+    outbound.send(send, chat_id=1, text='first')
+    outbound.send(send, chat_id=1, text='second')
+    outbound.start()
+    assert send.done.wait(5)
+    outbound.stop()
+    assert send.chat_ids == [1, 1, 1]  # the rejected message, again, then the second one
+    assert send.times[1] - send.times[0] >= 0.05
+    stats = outbound.stats()
+    assert (stats['sent'], stats['retried'], stats['failed']) == (2, 1, 0)
+
+
+def test_message_fails_after_max_retries():
+    send = FakeSend(expected=2, errors=[RetryAfter(0.01), RetryAfter(0.01)])
+    outbound = OutboundQueue(global_rate=1000, max_retries=1)
+    outbound.send(send, chat_id=1, text='Hi')
+    outbound.start()
+    assert send.done.wait(5)
+    outbound.stop()
+    stats = outbound.stats()
+    assert (stats['sent'], stats['retried'], stats['failed']) == (0, 1, 1)
@@ -0,0 +1,40 @@
+from src.render_state import RenderStateStore, render_hash
+
+
+class Keyboard:
+    # Stands for InlineKeyboardMarkup, render_hash() only calls to_dict()
+    def __init__(self, title):
+        self.title = title
+
+    def to_dict(self):
+        return {'inline_keyboard': [[{'text': self.title, 'callback_data': 'v1:main'}]]}
+
+
+def test_render_hash_covers_text_keyboard_and_parse_mode():
+    base = render_hash('Menu', Keyboard('Back'), 'Markdown')
+    assert render_hash('Menu', Keyboard('Back'), 'Markdown') == base
+    assert render_hash('Menu!', Keyboard('Back'), 'Markdown') != base
+    assert render_hash('Menu', Keyboard('Home'), 'Markdown') != base
+    assert render_hash('Menu', Keyboard('Back'), None) != base
+
+
+def test_unchanged_only_for_the_same_hash_until_ttl(clock):
+    store = RenderStateStore(ttl=10, clock=clock)
+    store.put(1, 100, 'a')
+    assert store.is_unchanged(1, 100, 'a')
+    assert not store.is_unchanged(1, 100, 'b')
+    assert not store.is_unchanged(1, 101, 'a')
+    clock.now = 10
+    assert not store.is_unchanged(1, 100, 'a')
+    assert store.stats() == {'skipped': 1, 'rendered': 1, 'size': 0}
+
+
+def test_oldest_entries_are_evicted_over_max_size(clock):
+    store = RenderStateStore(ttl=10, max_size=2, clock=clock)
+    store.put(1, 100, 'a')
+    store.put(2, 200, 'b')
+    store.put(1, 100, 'c')  # refreshed, 2 is now the oldest
+    store.put(3, 300, 'd')
+    assert not store.is_unchanged(2, 200, 'b')
+    assert store.is_unchanged(1, 100, 'c')
+    assert store.is_unchanged(3, 300, 'd')
@@ -0,0 +1,110 @@
+import pytest
+
+from src import resilience
+from src.resilience import CircuitBreaker, CircuitOpenError, ResilientCall, retry
+
+
+def fail():
+    raise OSError('down')
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(resilience.time, 'sleep', lambda seconds: None)
+
+
+def test_breaker_opens_after_threshold_and_fails_fast(clock):
+    breaker = CircuitBreaker('test-open', failure_threshold=2, reset_timeout=10, clock=clock)
+    for _ in range(2):
+        with pytest.raises(OSError):
+            breaker.call(fail)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    calls = []
+    with pytest.raises(CircuitOpenError):
+        breaker.call(calls.append, 1)
+    assert calls == []
+
+
+def test_breaker_success_resets_failure_count(clock):
+    breaker = CircuitBreaker('test-reset', failure_threshold=2, reset_timeout=10, clock=clock)
+    with pytest.raises(OSError):
+        breaker.call(fail)
+    assert breaker.call(lambda: 'ok') == 'ok'
+    with pytest.raises(OSError):
+        breaker.call(fail)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_trial_success_closes(clock):
+    breaker = CircuitBreaker('test-half-open', failure_threshold=1, reset_timeout=10, clock=clock)
+    with pytest.raises(OSError):
+        breaker.call(fail)
+    clock.now = 10
+    assert breaker.call(lambda: 'ok') == 'ok'
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_trial_failure_opens_again(clock):
+    breaker = CircuitBreaker('test-reopen', failure_threshold=3, reset_timeout=10, clock=clock)
+    for _ in range(3):
+        with pytest.raises(OSError):
+            breaker.call(fail)
+    clock.now = 10
+    with pytest.raises(OSError):
+        breaker.call(fail)  # a single failure is enough in half-open
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now = 15
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: 'ok')
+
+
+def test_retry_calls_up_to_attempts():
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise OSError('flaky')
+        return 'ok'
+
+    assert retry('test', flaky, attempts=3) == 'ok'
+    assert len(calls) == 3
+
+
+def test_retry_gives_up_after_attempts():
+    calls = []
+
+    def broken():
+        calls.append(1)
+        raise OSError('down')
+
+    with pytest.raises(OSError):
+        retry('test', broken, attempts=4)
+    assert len(calls) == 4
+
+
+def test_retry_does_not_retry_open_circuit():
+    calls = []
+
+    def open_circuit():
+        calls.append(1)
+        raise CircuitOpenError('open')
+
+    with pytest.raises(CircuitOpenError):
+        retry('test', open_circuit, attempts=3)
+    assert len(calls) == 1
+
+
+def test_resilient_call_counts_exhausted_retries_as_one_failure():
+    call = ResilientCall('test-resilient', failure_threshold=2, reset_timeout=10, attempts=3)
+    calls = []
+
+    def broken():
+        calls.append(1)
+        raise OSError('down')
+
+    with pytest.raises(OSError):
+        call(broken)
+    assert len(calls) == 3
+    assert call.breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,32 @@
+from src.session_cache import SessionCache
+
+
+def test_get_returns_cached_user_until_it_expires(clock):
+    cache = SessionCache(clock=clock)
+    cache.put(1, 'user', expires_at=100)
+    assert cache.get(1) == 'user'
+    clock.now = 100
+    assert cache.get(1) is None
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 0, 'size': 0}
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = SessionCache(max_size=2, clock=clock)
+    cache.put(1, 'one', expires_at=100)
+    cache.put(2, 'two', expires_at=100)
+    cache.get(1)  # 2 is now the least recently used
+    cache.put(3, 'three', expires_at=100)
+    assert cache.get(2) is None
+    assert cache.get(1) == 'one'
+    assert cache.get(3) == 'three'
+    assert cache.stats()['evictions'] == 1
+
+
+def test_invalidate_and_clear(clock):
+    cache = SessionCache(clock=clock)
+    cache.put(1, 'one', expires_at=100)
+    cache.put(2, 'two', expires_at=100)
+    cache.invalidate(1)
+    assert cache.get(1) is None
+    cache.clear()
+    assert cache.get(2) is None
@@ -0,0 +1,71 @@
+import multiprocessing
+from types import SimpleNamespace
+
+import pytest
+
+try:
+    from src.sharding import ShardSupervisor, get_shard
+except ImportError as e:  # src.sharding needs python-telegram-bot for the webhook server
+    pytest.skip(f'python-telegram-bot is not importable: {e}', allow_module_level=True)
+
+
+def make_update(update_id, chat_id=None, user_id=None):
+    return SimpleNamespace(
+        effective_chat=SimpleNamespace(id=chat_id) if chat_id is not None else None,
+        effective_user=SimpleNamespace(id=user_id) if user_id is not None else None,
+        to_dict=lambda: {'update_id': update_id},
+    )
+
+
+class FakeProcess:
+    # Stands for a spawned bot process: nothing runs, the test decides when it dies
+    def __init__(self, target, args, name, daemon):
+        self.args = args
+        self.exitcode = None
+
+    def start(self):
+        pass
+
+    def is_alive(self):
+        return self.exitcode is None
+
+
+@pytest.fixture
+def processes(monkeypatch):
+    started = []
+
+    def process(*args, **kwargs):
+        started.append(FakeProcess(*args, **kwargs))
+        return started[-1]
+
+    monkeypatch.setattr(multiprocessing.get_context('spawn'), 'Process', process)
+    return started
+
+
+def test_chat_id_picks_the_shard_and_the_user_id_stands_in_without_a_chat():
+    assert get_shard(make_update(1, chat_id=42, user_id=7), 8) == get_shard(make_update(2, chat_id=42), 8)
+    assert get_shard(make_update(3, user_id=42), 8) == get_shard(make_update(4, chat_id=42), 8)
+    assert get_shard(make_update(5), 8) == get_shard(make_update(6, chat_id=0), 8)
+
+
+def test_routing_is_stable_and_spreads_chats():
+    shards = [get_shard(make_update(chat_id, chat_id=chat_id), 4) for chat_id in range(1000)]
+    # crc32 rather than hash(): the same chat goes to the same shard in every process and after a restart
+    assert shards == [get_shard(make_update(chat_id, chat_id=chat_id), 4) for chat_id in range(1000)]
+    assert all(shards.count(shard) > 150 for shard in range(4))
+
+
+def test_restarted_shard_gets_a_new_queue_and_counts_stranded_updates_as_lost(processes):
+    supervisor = ShardSupervisor(1)
+    supervisor.start_worker(0)
+    for update_id in range(3):
+        supervisor.put(make_update(update_id, chat_id=42))
+    processes[0].exitcode = -9  # killed, possibly holding the queue's read lock
+
+    supervisor.restart_worker(0)
+
+    assert processes[1].args[2] is not processes[0].args[2]
+    stats = supervisor.stats()[0]
+    assert (stats['routed'], stats['queued'], stats['lost'], stats['restarts'], stats['alive']) == (3, 0, 3, 1, 1)
+    supervisor.put(make_update(3, chat_id=42))
+    assert processes[1].args[2].get(timeout=5) == {'update_id': 3}
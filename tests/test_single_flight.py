@@ -0,0 +1,118 @@
+import threading
+import time
+
+import pytest
+
+from src.single_flight import SingleFlight
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.001)
+
+
+def test_concurrent_calls_share_one_upstream_call():
+    flight = SingleFlight('test-share')
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return 'rates'
+
+    leader = threading.Thread(target=lambda: results.append(flight.do('key', fetch)))
+    leader.start()
+    wait_until(lambda: flight.stats()['in_flight'] == 1)
+    followers = [threading.Thread(target=lambda: results.append(flight.do('key', fetch))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    wait_until(lambda: flight.stats()['coalesced'] == 3)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert calls == [1]
+    assert results == ['rates'] * 4
+    assert flight.stats() == {'leader': 1, 'coalesced': 3, 'timeout': 0, 'in_flight': 0}
+
+
+def test_error_of_the_shared_call_reaches_every_caller():
+    flight = SingleFlight('test-error')
+    release = threading.Event()
+    errors = []
+
+    def fetch():
+        release.wait(5)
+        raise OSError('bnm.md is down')
+
+    def call():
+        try:
+            flight.do('key', fetch)
+        except OSError as e:
+            errors.append(str(e))
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    wait_until(lambda: flight.stats()['in_flight'] == 1)
+    follower = threading.Thread(target=call)
+    follower.start()
+    wait_until(lambda: flight.stats()['coalesced'] == 1)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert errors == ['bnm.md is down'] * 2
+
+
+def test_nothing_is_cached_after_the_call():
+    flight = SingleFlight('test-no-cache')
+    assert flight.do('key', lambda: 1) == 1
+    assert flight.do('key', lambda: 2) == 2
+
+
+def test_follower_times_out():
+    flight = SingleFlight('test-timeout')
+    release = threading.Event()
+    leader = threading.Thread(target=flight.do, args=('key', release.wait, 5))
+    leader.start()
+    wait_until(lambda: flight.stats()['in_flight'] == 1)
+    with pytest.raises(TimeoutError):
+        flight.do('key', lambda: None, timeout=0.01)
+    release.set()
+    leader.join(5)
+    assert flight.stats()['timeout'] == 1
+
+
+def test_base_exception_of_the_leader_reaches_waiters():
+    class Interrupted(BaseException):
+        pass
+
+    flight = SingleFlight('test-base-exception')
+    release = threading.Event()
+    errors = []
+
+    def fetch():
+        release.wait(5)
+        raise Interrupted()
+
+    def call():
+        try:
+            flight.do('key', fetch)
+        except Interrupted as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    wait_until(lambda: flight.stats()['in_flight'] == 1)
+    follower = threading.Thread(target=call)
+    follower.start()
+    wait_until(lambda: flight.stats()['coalesced'] == 1)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert len(errors) == 2  # not None for the follower